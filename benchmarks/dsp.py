@@ -0,0 +1,89 @@
+# Frames per second through DSPSource, the NumPy stage behind /volume,
+# AUDIO_NORMALIZE and CROSSFADE_SECONDS. A playing guild needs 50 frames/s, so
+# the last column is roughly how many guilds one core can keep fed.
+#
+#   python benchmarks/dsp.py [--frames 20000]
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix='musicbot-bench-'))
+
+import bot  # noqa: E402
+
+
+class PCMSource(bot.discord.AudioSource):
+    # Replays a few seconds of noise instead of reading from ffmpeg
+    def __init__(self, frames):
+        rng = bot.numpy.random.default_rng(0)
+        self.frames = [rng.integers(-12000, 12000, bot.FRAME_VALUES, dtype=bot.numpy.int16).tobytes() for _ in range(250)]
+        self.left = frames
+        self.index = 0
+
+    def read(self):
+        if self.left == 0:
+            return b''
+        self.left -= 1
+        self.index = (self.index + 1) % len(self.frames)
+        return self.frames[self.index]
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        pass
+
+
+class Player:
+    def __init__(self, volume):
+        self.volume = volume
+
+
+def run(source, frames):
+    start = time.perf_counter()
+    for _ in range(frames):
+        source.read()
+    return frames / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=20000)
+    args = parser.parse_args()
+    if bot.numpy is None:
+        sys.exit('NumPy is not installed')
+    n = args.frames
+    seconds = n * bot.FRAME_SECONDS
+
+    def dsp(volume=0.5, normalize=False, crossfade=0.0):
+        bot.AUDIO_NORMALIZE = normalize
+        bot.CROSSFADE_SECONDS = crossfade
+        source = bot.DSPSource(PCMSource(n), Player(volume), seconds)
+        if crossfade:
+            # Every frame falls inside the fade, so each one mixes two tracks
+            source.upcoming = bot.DSPSource(PCMSource(n), Player(volume), seconds)
+        return source
+
+    cases = [
+        ('raw read (no DSP)', lambda: PCMSource(n)),
+        ('volume', lambda: dsp()),
+        ('volume + normalize', lambda: dsp(normalize=True)),
+        ('crossfade', lambda: dsp(crossfade=seconds * 2)),
+        ('crossfade + normalize', lambda: dsp(normalize=True, crossfade=seconds * 2)),
+    ]
+    transformer = getattr(bot.discord, 'PCMVolumeTransformer', None)
+    if transformer is not None:
+        cases.append(('PCMVolumeTransformer', lambda: transformer(PCMSource(n), volume=0.5)))
+
+    print(f'{"stage":<26}{"frames/s":>12}{"us/frame":>11}{"guilds/core":>13}')
+    for name, make in cases:
+        rate = max(run(make(), n) for _ in range(3))
+        print(f'{name:<26}{rate:>12.0f}{1e6 / rate:>11.1f}{rate / 50:>13.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+# Offline stand-ins for YouTube, ffmpeg and the Discord voice/interaction
+# objects, just enough for bot.py's command handlers to run in-process.
+import asyncio
+import datetime
+import hashlib
+import random
+import threading
+import time
+
+
+FRAME_SECONDS = 0.02
+# One 20 ms Opus frame of silence
+SILENCE_FRAME = b'\xf8\xff\xfe'
+
+
+class FakeExtractor:
+    # Replaces bot.extract_info / bot.extract_flat. latency simulates the
+    # blocking time of a real extraction; failure_rate is the share of
+    # extract_info calls that raise, like an unavailable video.
+    def __init__(self, latency=0.0, playlist_size=50, failure_rate=0.0, duration=200, seed=0):
+        self.latency = latency
+        self.playlist_size = playlist_size
+        self.failure_rate = failure_rate
+        self.duration = duration
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.failures = 0
+
+    def extract_info(self, url):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self.rng.random() < self.failure_rate:
+            self.failures += 1
+            raise Exception('Video unavailable')
+        video_id = hashlib.md5(url.encode()).hexdigest()[:11]
+        return {
+            'id': video_id,
+            'title': f'Track {video_id}',
+            'duration': self.duration,
+            'duration_string': f'{self.duration // 60}:{self.duration % 60:02d}',
+            'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+            'url': f'https://rr1.googlevideo.com/videoplayback?expire={int(time.time()) + 21600}&id={video_id}',
+            'acodec': 'opus',
+            'asr': 48000,
+        }
+
+    def extract_flat(self, url):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        seed = hashlib.md5(url.encode()).hexdigest()[:6]
+        return {'_type': 'playlist', 'entries': [
+            {'id': f'{seed}{i:05d}', 'url': f'https://www.youtube.com/watch?v={seed}{i:05d}', 'title': f'Flat {i}', 'duration': 180}
+            for i in range(self.playlist_size)
+        ]}
+
+
+class FakeSource:
+    # Takes the place of FFmpegOpusAudio/FFmpegPCMAudio without spawning ffmpeg.
+    # Yields frames of silence, then ends; with frames=0 it ends straight away.
+    def __init__(self, source, frames=0, **kwargs):
+        self.source = source
+        self.frames = frames
+
+    def read(self):
+        if self.frames <= 0:
+            return b''
+        self.frames -= 1
+        return SILENCE_FRAME
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    def __init__(self, channel):
+        self.channel = channel
+        self.source = None
+        self.after = None
+        self.paused = False
+        self.connected = True
+        self.played = 0
+
+    def play(self, source, after=None):
+        self.source = source
+        self.after = after
+        self.paused = False
+        self.played += 1
+
+    def is_playing(self):
+        return self.source is not None and not self.paused
+
+    def is_paused(self):
+        return self.source is not None and self.paused
+
+    def is_connected(self):
+        return self.connected
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def stop(self):
+        # discord.py calls the after-callback from its voice thread
+        after, self.source, self.after = self.after, None, None
+        if after is not None:
+            threading.Thread(target=after, args=(None,)).start()
+
+    async def disconnect(self, force=False):
+        self.connected = False
+        self.source = None
+
+
+class RealtimeVoiceClient(FakeVoiceClient):
+    # Reads the source on its own thread every 20 ms, like discord.py's
+    # AudioPlayer, and records how far behind schedule each frame was read
+    def __init__(self, channel):
+        super().__init__(channel)
+        self.end = threading.Event()
+        self.end.set()
+        self.frames = 0
+        self.late = []  # seconds behind for frames more than one frame late
+
+    def play(self, source, after=None):
+        self.source = source
+        self.paused = False
+        self.played += 1
+        self.end = threading.Event()
+        threading.Thread(target=self.run, args=(source, self.end, after), daemon=True).start()
+
+    def run(self, source, end, after):
+        start = time.perf_counter()
+        loops = 0
+        while not end.is_set():
+            if self.paused:
+                # Like discord.py, the schedule restarts after a pause
+                end.wait(FRAME_SECONDS)
+                start = time.perf_counter()
+                loops = 0
+                continue
+            data = source.read()
+            if not data:
+                break
+            loops += 1
+            delay = start + FRAME_SECONDS * loops - time.perf_counter()
+            self.frames += 1
+            if delay < -FRAME_SECONDS:
+                self.late.append(-delay)
+            if delay > 0:
+                end.wait(delay)
+        end.set()
+        source.cleanup()
+        if self.source is source:
+            self.source = None
+        if after is not None:
+            after(None)
+
+    def is_playing(self):
+        return not self.end.is_set() and not self.paused
+
+    def is_paused(self):
+        return not self.end.is_set() and self.paused
+
+    def stop(self):
+        self.end.set()
+
+    async def disconnect(self, force=False):
+        self.connected = False
+        self.end.set()
+
+
+class FakeChannel:
+    def __init__(self, channel_id, realtime=False):
+        self.id = channel_id
+        self.name = f'voice-{channel_id}'
+        self.members = []
+        self.realtime = realtime
+        self.clients = []
+
+    async def connect(self, **kwargs):
+        vc = RealtimeVoiceClient(self) if self.realtime else FakeVoiceClient(self)
+        self.clients.append(vc)
+        return vc
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+
+class FakeResponse:
+    def __init__(self):
+        self.done = False
+        self.content = None
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self.done = True
+        self.content = content
+
+    def is_done(self):
+        return self.done
+
+
+class FakeFollowup:
+    def __init__(self):
+        self.content = None
+
+    async def send(self, content=None, wait=False, **kwargs):
+        self.content = content
+        return FakeMessage(content)
+
+
+class FakeRole:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeUser:
+    def __init__(self, user_id, channel=None):
+        self.id = user_id
+        self.roles = [FakeRole('Music Guy')]
+        self.voice = FakeVoiceState(channel) if channel else None
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f'guild-{guild_id}'
+
+
+class FakeInteraction:
+    def __init__(self, guild_id, user_id, channel=None):
+        self.guild = FakeGuild(guild_id)
+        self.guild_id = guild_id
+        self.user = FakeUser(user_id, channel)
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.command = None
+
+
+def install(bot, extractor):
+    # Patch the module-level hooks bot.py calls; nothing here touches the network
+    bot.extract_info = extractor.extract_info
+    bot.extract_flat = extractor.extract_flat
+    bot.discord.FFmpegOpusAudio = FakeSource
+    bot.discord.FFmpegPCMAudio = FakeSource
+    bot.bot.loop = asyncio.get_running_loop()
+
+
+def handler(command):
+    # app_commands.Command wraps the coroutine; call it directly
+    return getattr(command, 'callback', command)
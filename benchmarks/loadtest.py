@@ -0,0 +1,230 @@
+# Multi-guild load test: the bot's command tree driven in-process, without a
+# gateway, by N simulated guilds issuing a mix of /play, /playlist-play,
+# /playlist-add, /queue and /leave. Extraction goes through the real
+# scheduler and resolver against a stub with configurable latency and failure
+# rate; voice clients read their sources on their own threads in real time.
+#
+#   python benchmarks/loadtest.py [--guilds 10,50,100,200,500] [--duration 20]
+#                                 [--think 5] [--extract-latency 300] [--failure-rate 0.02]
+#
+# For each guild count it reports command latency percentiles, late frames
+# (read more than one 20 ms frame behind schedule, i.e. a late voice packet),
+# event loop lag, CPU and RSS. The knee is the first step where late frames
+# or command p99 cross --max-late / --max-p99.
+import argparse
+import asyncio
+import functools
+import gc
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix='musicbot-load-'))
+
+import bot  # noqa: E402
+import fakes  # noqa: E402
+
+PLAYLIST = 'load'
+SEED_SONGS = 20
+# Relative weights of each command in the mix
+COMMAND_MIX = (('play', 30), ('queue', 30), ('playlist-add', 20), ('playlist-play', 12), ('leave', 8))
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def rss_mb():
+    # Current RSS; ru_maxrss (KiB on Linux) only ever goes up
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Guild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.channel = fakes.FakeChannel(guild_id, realtime=True)
+
+    def interaction(self):
+        return fakes.FakeInteraction(self.id, self.id, self.channel)
+
+
+class Step:
+    def __init__(self):
+        self.latencies = {name: [] for name, _ in COMMAND_MIX}
+        self.errors = 0
+        self.raised = set()
+        self.lags = []
+
+
+def track_url(rng, n_tracks):
+    # Low numbers are requested far more often than the rest, so the
+    # resolver cache sees a realistic mix of hits and misses
+    return f'https://www.youtube.com/watch?v=load{int(n_tracks * rng.random() ** 3):07d}'
+
+
+async def run_command(step, name, interaction, *args):
+    command = fakes.handler(bot.bot.tree.get_command(name))
+    start = time.perf_counter()
+    try:
+        await bot.bot.tree.interaction_check(interaction)
+        await command(interaction, *args)
+    except Exception as e:
+        step.errors += 1
+        # Once per kind; an unhandled exception is a bug in the handler
+        if (name, type(e)) not in step.raised:
+            step.raised.add((name, type(e)))
+            print(f'/{name} raised {e!r}')
+    step.latencies.setdefault(name, []).append(time.perf_counter() - start)
+    reply = interaction.followup.content or interaction.response.content or ''
+    if reply.startswith(('❌', 'Error')):
+        step.errors += 1
+
+
+async def drive_guild(step, guild, rng, args, stop_at):
+    names = [name for name, _ in COMMAND_MIX]
+    weights = [weight for _, weight in COMMAND_MIX]
+    # Spread the first commands out instead of every guild starting at once
+    await asyncio.sleep(rng.uniform(0, args.think))
+    while time.monotonic() < stop_at:
+        name = rng.choices(names, weights)[0]
+        if name == 'play':
+            extra = (track_url(rng, args.tracks),)
+        elif name == 'playlist-add':
+            extra = (PLAYLIST, track_url(rng, args.tracks))
+        elif name == 'playlist-play':
+            extra = (PLAYLIST,)
+        else:
+            extra = ()
+        await run_command(step, name, guild.interaction(), *extra)
+        await asyncio.sleep(rng.expovariate(1 / args.think))
+
+
+async def sample_loop_lag(step, interval=0.05):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        step.lags.append(max(0.0, time.monotonic() - start - interval))
+
+
+async def seed_guild(guild, rng, n_tracks):
+    await run_command(Step(), 'playlist-create', guild.interaction(), PLAYLIST)
+    playlist = bot.db.get_playlist_by_name(PLAYLIST, str(guild.id), str(guild.id))
+    bot.db.add_songs(playlist["id"], [(track_url(rng, n_tracks), f'Seed {i}', '0:20') for i in range(SEED_SONGS)])
+
+
+async def run_step(guilds, rng, args):
+    step = Step()
+    clients_before = {g.id: len(g.channel.clients) for g in guilds}
+    cpu_start, wall_start = cpu_seconds(), time.monotonic()
+    sampler = asyncio.create_task(sample_loop_lag(step))
+    stop_at = time.monotonic() + args.duration
+    await asyncio.gather(*(drive_guild(step, g, random.Random(rng.random()), args, stop_at) for g in guilds))
+    sampler.cancel()
+    cpu = (cpu_seconds() - cpu_start) / (time.monotonic() - wall_start)
+    rss = rss_mb()
+    for player in list(bot.players.values()):
+        await player.disconnect()
+    # Let the voice threads see the disconnect before counting their frames
+    await asyncio.sleep(0.1)
+    clients = [vc for g in guilds for vc in g.channel.clients[clients_before[g.id]:]]
+    late = sorted(t for vc in clients for t in vc.late)
+    samples = sorted(t for times in step.latencies.values() for t in times)
+    return {
+        "guilds": len(guilds),
+        "commands": len(samples),
+        "commands_per_sec": len(samples) / args.duration,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "errors": step.errors,
+        "frames": sum(vc.frames for vc in clients),
+        "late": len(late),
+        "worst_late_ms": (late[-1] if late else 0.0) * 1000,
+        "lag_p99_ms": percentile(sorted(step.lags), 99) * 1000,
+        "cpu_pct": cpu * 100,
+        "rss_mb": rss,
+        "by_command": {name: sorted(times) for name, times in step.latencies.items()},
+    }
+
+
+def print_row(row):
+    late_pct = row["late"] / row["frames"] * 100 if row["frames"] else 0.0
+    print(f'{row["guilds"]:>7}{row["commands_per_sec"]:>8.1f}{row["p50_ms"]:>9.1f}{row["p99_ms"]:>9.1f}{row["errors"]:>8}'
+          f'{row["frames"]:>10}{late_pct:>8.2f}{row["worst_late_ms"]:>10.1f}{row["lag_p99_ms"]:>9.1f}{row["cpu_pct"]:>7.0f}{row["rss_mb"]:>8.0f}')
+    return late_pct
+
+
+async def run(args):
+    extractor = fakes.FakeExtractor(args.extract_latency / 1000, failure_rate=args.failure_rate,
+                                    duration=args.track_seconds, seed=args.seed)
+    fakes.install(bot, extractor)
+    # Sources that last as long as the extractor says the track does
+    bot.discord.FFmpegOpusAudio = functools.partial(fakes.FakeSource, frames=int(args.track_seconds / fakes.FRAME_SECONDS))
+    bot.discord.FFmpegPCMAudio = bot.discord.FFmpegOpusAudio
+    await bot.db.ensure_loaded()
+    bot.db.start_write_behind()
+    rng = random.Random(args.seed)
+    guilds = []
+    print(f'{"guilds":>7}{"cmd/s":>8}{"p50 ms":>9}{"p99 ms":>9}{"errors":>8}{"frames":>10}{"late %":>8}{"worst ms":>10}'
+          f'{"lag ms":>9}{"cpu %":>7}{"rss MB":>8}')
+    knee = None
+    rows = []
+    for count in sorted(int(n) for n in args.guilds.split(',')):
+        while len(guilds) < count:
+            guild = Guild(len(guilds) + 1)
+            await seed_guild(guild, rng, args.tracks)
+            guilds.append(guild)
+        gc.collect()
+        row = await run_step(guilds, rng, args)
+        rows.append(row)
+        late_pct = print_row(row)
+        if knee is None and (late_pct > args.max_late or row["p99_ms"] > args.max_p99):
+            knee = count
+    if args.per_command:
+        last = rows[-1]
+        print(f'\nBy command at {last["guilds"]} guilds:')
+        print(f'{"command":<16}{"count":>8}{"p50 ms":>9}{"p99 ms":>9}')
+        for name, times in last["by_command"].items():
+            print(f'{name:<16}{len(times):>8}{percentile(times, 50) * 1000:>9.1f}{percentile(times, 99) * 1000:>9.1f}')
+    print(f'extractor calls {extractor.calls}, failures {extractor.failures}')
+    if knee is None:
+        print(f'No knee: every step stayed under {args.max_late}% late frames and {args.max_p99:.0f} ms command p99')
+    else:
+        print(f'Knee at {knee} guilds (late frames > {args.max_late}% or command p99 > {args.max_p99:.0f} ms)')
+    await bot.db.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guilds', default='10,50,100,200,500', help='guild counts to step through')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per step')
+    parser.add_argument('--think', type=float, default=5.0, help='mean seconds between commands in a guild')
+    parser.add_argument('--tracks', type=int, default=1000, help='distinct tracks to pick from')
+    parser.add_argument('--track-seconds', type=int, default=30)
+    parser.add_argument('--extract-latency', type=float, default=300.0, help='simulated extraction time in ms')
+    parser.add_argument('--failure-rate', type=float, default=0.02, help='share of extractions that fail')
+    parser.add_argument('--max-late', type=float, default=1.0, help='late frame percentage that marks the knee')
+    parser.add_argument('--max-p99', type=float, default=2000.0, help='command p99 in ms that marks the knee')
+    parser.add_argument('--per-command', action='store_true', help='break down latency by command for the last step')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
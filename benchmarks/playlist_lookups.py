@@ -0,0 +1,81 @@
+# Shows that PlaylistDB lookups stay flat as the total playlist count grows.
+#
+#   python benchmarks/playlist_lookups.py [--sizes 1000,10000,100000]
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix='musicbot-bench-'))
+
+import bot  # noqa: E402
+
+PLAYLISTS_PER_GUILD = 10
+
+
+def make_data(n_playlists):
+    data = {"playlists": [], "songs": {}, "next_id": n_playlists + 1}
+    for i in range(n_playlists):
+        data["playlists"].append({
+            "id": i + 1,
+            "name": f'playlist-{i % PLAYLISTS_PER_GUILD}',
+            "user_id": str(i % 7),
+            "guild_id": str(i // PLAYLISTS_PER_GUILD),
+            "is_public": i % 3 == 0,
+            "created_at": "2026-01-01T00:00:00"
+        })
+        data["songs"][str(i + 1)] = []
+    return data
+
+
+def load_db(data, workdir):
+    path = os.path.join(workdir, f'playlists-{len(data["playlists"])}.json')
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    return bot.PlaylistDB(path, bot.JSONFileStorage(path))
+
+
+def bench(db, n_playlists, number):
+    rng = random.Random(n_playlists)
+    samples = [rng.choice(list(db.data["playlists"].values())) for _ in range(number)]
+    private = [p for p in samples if not p["is_public"]] or samples
+    public = [p for p in samples if p["is_public"]] or samples
+    cases = [
+        ('get_playlist_by_name', private, lambda p: db.get_playlist_by_name(p["name"], p["user_id"], p["guild_id"])),
+        ('get_public_playlist_by_name', public, lambda p: db.get_public_playlist_by_name(p["name"], p["guild_id"])),
+        ('get_user_playlists_in_guild', samples, lambda p: db.get_user_playlists_in_guild(p["user_id"], p["guild_id"])),
+        ('get_public_playlists_in_guild', samples, lambda p: db.get_public_playlists_in_guild(p["guild_id"])),
+        # What every lookup used to cost, for comparison
+        ('linear scan (old)', samples[:50], lambda p: next(q for q in db.data["playlists"].values() if q["id"] == p["id"])),
+    ]
+    results = {}
+    for name, keys, fn in cases:
+        best = min(timeit.repeat(lambda: [fn(p) for p in keys], number=1, repeat=5))
+        results[name] = best / len(keys) * 1e6
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    workdir = tempfile.mkdtemp(prefix='musicbot-bench-')
+    table = {}
+    for n in sizes:
+        db = load_db(make_data(n), workdir)
+        table[n] = bench(db, n, args.lookups)
+    names = list(next(iter(table.values())))
+    print(f'{"us/op":<32}' + ''.join(f'{n:>12,}' for n in sizes))
+    for name in names:
+        print(f'{name:<32}' + ''.join(f'{table[n][name]:>12.2f}' for n in sizes))
+
+
+if __name__ == '__main__':
+    main()
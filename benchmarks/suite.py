@@ -0,0 +1,245 @@
+# Offline benchmark suite: PlaylistDB on a synthetic dataset, and the slash
+# command handlers driven in-process against a fake extractor and voice client.
+#
+#   python benchmarks/suite.py [--scale small|medium|large] [--storage log|sqlite|json]
+#                              [--only db,commands] [--ops 2000]
+#                              [--save-baseline FILE] [--compare FILE [--tolerance 0.2]]
+#
+# Reports ops/sec, p50/p99 latency and the process's peak RSS after each step.
+# --compare exits with status 1 if any step is slower than the baseline by more
+# than the tolerance.
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='musicbot-bench-')
+os.environ["DATA_DIR"] = os.path.join(WORKDIR, 'data')
+
+import bot  # noqa: E402
+import synthetic  # noqa: E402
+import fakes  # noqa: E402
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class Results:
+    def __init__(self):
+        self.rows = {}
+
+    def record(self, name, samples, batch=1):
+        # batch: operations covered by each sample, for steps timed as a whole
+        ordered = sorted(samples)
+        total = sum(ordered)
+        self.rows[name] = {
+            "ops": len(ordered) * batch,
+            "ops_per_sec": len(ordered) * batch / total if total else 0.0,
+            "p50_us": percentile(ordered, 50) * 1e6,
+            "p99_us": percentile(ordered, 99) * 1e6,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+def timed(fn, calls):
+    samples = []
+    for args in calls:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def timed_async(fn, calls):
+    samples = []
+    for args in calls:
+        start = time.perf_counter()
+        await fn(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def bench_db(results, scale, storage, n_ops, rng):
+    workdir = os.path.join(WORKDIR, f'db-{storage}')
+    os.makedirs(workdir)
+    legacy_path = synthetic.dataset_path(workdir, scale)
+    playlists = synthetic.write_dataset(legacy_path, scale)["playlists"]
+    gc.collect()
+
+    if storage != 'json':
+        # First open imports the legacy file into the backend
+        start = time.perf_counter()
+        db = bot.PlaylistDB(legacy_path, bot.create_storage(storage, legacy_path))
+        results.record('db.migrate', [time.perf_counter() - start])
+        db.close()
+        del db
+        gc.collect()
+    start = time.perf_counter()
+    db = bot.PlaylistDB(legacy_path, bot.create_storage(storage, legacy_path))
+    results.record('db.load', [time.perf_counter() - start])
+
+    private = [p for p in playlists if not p["is_public"]]
+    public = [p for p in playlists if p["is_public"]]
+    sample = [rng.choice(private) for _ in range(n_ops)]
+    results.record('db.get_playlist_by_name', timed(db.get_playlist_by_name, [(p["name"], p["user_id"], p["guild_id"]) for p in sample]))
+    results.record('db.get_public_playlist_by_name', timed(db.get_public_playlist_by_name,
+                                                           [(p["name"], p["guild_id"]) for p in (rng.choice(public) for _ in range(n_ops))]))
+    results.record('db.get_user_playlists_in_guild', timed(db.get_user_playlists_in_guild, [(p["user_id"], p["guild_id"]) for p in sample]))
+    results.record('db.get_songs', timed(db.get_songs, [(p["id"],) for p in sample]))
+    # The first search in a guild builds its index; later ones reuse it
+    results.record('db.search_playlists', timed(db.search_playlists, [(p["guild_id"], p["name"][:3], 25) for p in sample]))
+    results.record('db.search_songs', timed(db.search_songs, [(p["guild_id"], 'song', 25) for p in sample]))
+
+    results.record('db.create_playlist', timed(db.create_new_playlist,
+                                               [(f'bench-{i}', p["user_id"], p["guild_id"]) for i, p in enumerate(sample)]))
+    results.record('db.add_song', timed(db.add_song,
+                                        [(p["id"], f'https://www.youtube.com/watch?v=bench{i:06d}', f'Bench {i}', '3:00') for i, p in enumerate(sample)]))
+
+    def move(playlist_id):
+        count = db.count_songs(playlist_id)
+        db.move_song_in_playlist(playlist_id, rng.randint(1, count), rng.randint(1, count))
+
+    def remove(playlist_id):
+        song = db.get_song_at(playlist_id, rng.randint(1, db.count_songs(playlist_id)))
+        db.remove_song_from_playlist(playlist_id, song["id"])
+
+    results.record('db.move_song', timed(move, [(p["id"],) for p in sample]))
+    results.record('db.remove_song', timed(remove, [(p["id"],) for p in sample]))
+    results.record('db.shuffle', timed(db.shuffle_playlist, [(p["id"],) for p in sample[:max(1, n_ops // 10)]]))
+
+    pending = len(db.pending)
+    start = time.perf_counter()
+    if db.write_behind:
+        await db.flush()
+    results.record('db.flush', [time.perf_counter() - start], batch=max(1, pending))
+    db.close()
+
+
+async def bench_commands(results, n_ops, rng, extractor):
+    fakes.install(bot, extractor)
+    await bot.db.ensure_loaded()
+    n_guilds = max(1, min(50, n_ops // 20))
+    channels = {g: fakes.FakeChannel(g) for g in range(1, n_guilds + 1)}
+
+    def ix(i, user=1):
+        g = i % n_guilds + 1
+        return fakes.FakeInteraction(g, user, channels[g])
+
+    create = fakes.handler(bot.playlist_create)
+    add = fakes.handler(bot.playlist_add)
+    results.record('cmd.playlist_create', await timed_async(create, [(ix(g), 'bench') for g in range(n_guilds)]))
+    urls = [f'https://www.youtube.com/watch?v=cmd{i:08d}' for i in range(n_ops)]
+    results.record('cmd.playlist_add (extract)', await timed_async(add, [(ix(i), 'bench', url) for i, url in enumerate(urls)]))
+    results.record('cmd.playlist_add (cached)', await timed_async(add, [(ix(i), 'bench', url) for i, url in enumerate(urls)]))
+    results.record('cmd.playlist_show', await timed_async(fakes.handler(bot.playlist_show), [(ix(i), 'bench') for i in range(n_ops)]))
+    results.record('cmd.playlist_move', await timed_async(fakes.handler(bot.playlist_move),
+                                                          [(ix(i), 'bench', rng.randint(1, 10), rng.randint(11, 20)) for i in range(n_ops)]))
+    results.record('cmd.playlists_all', await timed_async(fakes.handler(bot.playlists_all), [(ix(i),) for i in range(n_ops)]))
+
+    results.record('cmd.play', await timed_async(fakes.handler(bot.play), [(ix(i), url) for i, url in enumerate(urls)]))
+    results.record('cmd.queue', await timed_async(fakes.handler(bot.queue_cmd), [(ix(i),) for i in range(n_ops)]))
+    results.record('cmd.queue_move', await timed_async(fakes.handler(bot.queue_move), [(ix(i), 1, 5) for i in range(n_ops)]))
+
+    # A skip returns once the track is stopped; the next one starts from the
+    # after-callback, so time that hand-over separately
+    skip = fakes.handler(bot.skip)
+    skip_samples = []
+    advance_samples = []
+    for i in range(min(n_ops, n_guilds * 10)):
+        interaction = ix(i)
+        player = bot.players[interaction.guild.id]
+        start = time.perf_counter()
+        await skip(interaction)
+        skip_samples.append(time.perf_counter() - start)
+        while not player.vc.is_playing() and player.queue:
+            await asyncio.sleep(0)
+        advance_samples.append(time.perf_counter() - start)
+    results.record('cmd.skip', skip_samples)
+    results.record('player.advance', advance_samples)
+
+    results.record('cmd.playlist_play', await timed_async(fakes.handler(bot.playlist_play), [(ix(i), 'bench') for i in range(n_guilds)]))
+    results.record('cmd.playlist_remove', await timed_async(fakes.handler(bot.playlist_remove), [(ix(i), 'bench', 1) for i in range(n_ops)]))
+    results.record('cmd.playlist_import', await timed_async(fakes.handler(bot.playlist_import),
+                                                            [(ix(i), 'bench', f'https://www.youtube.com/playlist?list=PLbench{i}') for i in range(n_guilds)]))
+    results.record('cmd.leave', await timed_async(fakes.handler(bot.leave), [(ix(g),) for g in range(n_guilds)]))
+    await bot.db.flush()
+
+
+def print_table(rows, baseline=None, tolerance=0.2):
+    regressions = []
+    header = f'{"step":<34}{"ops":>9}{"ops/s":>12}{"p50 us":>11}{"p99 us":>11}{"rss MB":>9}'
+    if baseline:
+        header += f'{"vs base":>10}'
+    print(header)
+    for name, row in rows.items():
+        line = f'{name:<34}{row["ops"]:>9}{row["ops_per_sec"]:>12.0f}{row["p50_us"]:>11.1f}{row["p99_us"]:>11.1f}{row["peak_rss_mb"]:>9.0f}'
+        base = (baseline or {}).get(name)
+        if base and base["ops_per_sec"]:
+            change = row["ops_per_sec"] / base["ops_per_sec"] - 1
+            line += f'{change:>+10.0%}'
+            if change < -tolerance:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    results = Results()
+    only = set(args.only.split(','))
+    if 'db' in only:
+        await bench_db(results, args.scale, args.storage, args.ops, rng)
+    if 'commands' in only:
+        await bench_commands(results, args.ops, rng, fakes.FakeExtractor(args.extract_latency / 1000))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', choices=sorted(synthetic.SCALES), default='medium')
+    parser.add_argument('--storage', choices=('log', 'sqlite', 'json'), default=bot.PLAYLIST_STORAGE)
+    parser.add_argument('--only', default='db,commands')
+    parser.add_argument('--ops', type=int, default=2000)
+    parser.add_argument('--extract-latency', type=float, default=0.0, help='simulated extraction time in ms')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if (saved["scale"], saved["storage"], saved["ops"]) != (args.scale, args.storage, args.ops):
+            print(f'Warning: baseline was recorded with scale={saved["scale"]} storage={saved["storage"]} ops={saved["ops"]}')
+        baseline = saved["results"]
+    print(f'scale={args.scale} storage={args.storage} ops={args.ops}')
+    regressions = print_table(results.rows, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({"scale": args.scale, "storage": args.storage, "ops": args.ops, "results": results.rows}, f, indent=2)
+        print(f'Saved baseline to {args.save_baseline}')
+    if regressions:
+        print(f'{len(regressions)} steps slower than the baseline by more than {args.tolerance:.0%}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
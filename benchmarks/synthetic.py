@@ -0,0 +1,65 @@
+# Synthetic playlists.json files in the legacy format, seeded so every run of
+# the same scale produces the same data.
+import json
+import os
+import random
+
+SCALES = {
+    'small': {'guilds': 100, 'playlists': 1000, 'songs': 10000},
+    'medium': {'guilds': 1000, 'playlists': 10000, 'songs': 100000},
+    'large': {'guilds': 10000, 'playlists': 100000, 'songs': 1000000},
+}
+USERS_PER_GUILD = 5
+PUBLIC_EVERY = 4
+
+
+def guild_id(i):
+    return str(100000000000000000 + i)
+
+
+def user_id(i):
+    return str(200000000000000000 + i)
+
+
+def make_dataset(guilds, playlists, songs, seed=0):
+    rng = random.Random(seed)
+    data = {"playlists": [], "songs": {}, "next_id": 1}
+    per_playlist = songs // playlists
+    next_id = 1
+    for i in range(playlists):
+        playlist_id = next_id
+        next_id += 1
+        data["playlists"].append({
+            "id": playlist_id,
+            "name": f'playlist-{i // guilds}',
+            "user_id": user_id(rng.randrange(USERS_PER_GUILD)),
+            "guild_id": guild_id(i % guilds),
+            "is_public": i % PUBLIC_EVERY == 0,
+            "created_at": "2026-01-01T00:00:00"
+        })
+        rows = []
+        for position in range(1, per_playlist + 1):
+            video = f'{rng.getrandbits(40):011x}'
+            rows.append({
+                "id": next_id,
+                "playlist_id": playlist_id,
+                "url": f'https://www.youtube.com/watch?v={video}',
+                "title": f'Song {video}',
+                "duration": f'{rng.randrange(1, 10)}:{rng.randrange(60):02d}',
+                "position": position
+            })
+            next_id += 1
+        data["songs"][str(playlist_id)] = rows
+    data["next_id"] = next_id
+    return data
+
+
+def write_dataset(path, scale, seed=0):
+    data = make_dataset(seed=seed, **SCALES[scale])
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    return data
+
+
+def dataset_path(workdir, scale):
+    return os.path.join(workdir, f'playlists-{scale}.json')
@@ -1,15 +1,38 @@
+import time
+# Taken before the other imports so the startup report counts them
+BOOT_STARTED = time.perf_counter()
 import discord
 from discord import app_commands
-from discord.ext import commands
-import yt_dlp
+from discord.ext import commands, tasks
 import os
 import asyncio
 import json
+import hashlib
+import signal
+import sqlite3
+import threading
 import tempfile
 import shutil
 from datetime import datetime
 import platform
 import random
+import re
+import itertools
+import bisect
+import heapq
+import concurrent.futures
+import subprocess
+import select
+import sys
+from array import array
+from collections import OrderedDict, deque
+from urllib.parse import urlparse, parse_qs
+from sortedcontainers import SortedKeyList, SortedList
+try:
+    # Optional: only the volume/normalization/crossfade stage needs it
+    import numpy
+except ImportError:
+    numpy = None
 
 # Load Opus for voice encoding
 if not discord.opus.is_loaded():
@@ -30,51 +53,919 @@ if not discord.opus.is_loaded():
         print("Warning: Unsupported architecture. Opus library not loaded. Voice features may not work.")
 
 
+def parse_shard_ids(spec):
+    # "0-3" or "0,2,5-7"
+    ids = set()
+    for part in spec.split(','):
+        first, _, last = part.strip().partition('-')
+        ids.update(range(int(first), int(last or first) + 1))
+    return sorted(ids)
+
+# Unset runs one unsharded connection; "auto" lets Discord pick the shard count.
+# With a fixed count, SHARD_IDS picks the shards this process runs so several
+# processes can split them.
+SHARD_COUNT = os.environ.get("SHARD_COUNT")
+SHARD_IDS = parse_shard_ids(os.environ["SHARD_IDS"]) if os.environ.get("SHARD_IDS") else None
+if SHARD_IDS is not None and (SHARD_COUNT is None or SHARD_COUNT == 'auto'):
+    raise ValueError("SHARD_IDS needs a numeric SHARD_COUNT")
+# Other processes run the remaining shards and share the playlist database
+MULTI_PROCESS = SHARD_IDS is not None and len(SHARD_IDS) < int(SHARD_COUNT)
+# Keeps per-process cache files apart when several processes share DATA_DIR
+PROCESS_SUFFIX = f'-shard{SHARD_IDS[0]}' if MULTI_PROCESS else ''
+
+def owns_guild(guild_id):
+    if not MULTI_PROCESS:
+        return True
+    return (int(guild_id) >> 22) % int(SHARD_COUNT) in SHARD_IDS
+
+startup_times = {"imports": time.perf_counter() - BOOT_STARTED}  # phase -> seconds
+
+def mark_startup(phase, started=BOOT_STARTED):
+    startup_times[phase] = time.perf_counter() - started
+
+class MusicTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        # Playlists load in the background at startup; only the first
+        # commands after a restart can end up waiting here
+        await db.ensure_loaded()
+        return True
+
 intents = discord.Intents.default()
 intents.voice_states = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+if SHARD_COUNT is None:
+    bot = commands.Bot(command_prefix='!', intents=intents, tree_cls=MusicTree)
+elif SHARD_COUNT == 'auto':
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, tree_cls=MusicTree)
+else:
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, tree_cls=MusicTree,
+                                  shard_count=int(SHARD_COUNT), shard_ids=SHARD_IDS)
 
-connections = {}
-# players = {}  # Removed as it's not needed
-queues = {}
+players = {}  # guild_id -> GuildPlayer
+playback_paths = {}  # guild_id -> {'opus': n, 'pcm': n}
+# Counts from guilds whose player has been reaped, so the totals never go down
+retired_playback_paths = {'opus': 0, 'pcm': 0, 'cache': 0}
 
 DATA_DIR = os.environ.get("DATA_DIR", os.path.join(os.path.dirname(__file__), "data"))
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Prometheus text endpoint on METRICS_HOST:METRICS_PORT/metrics; 0 turns metrics off
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+LOOP_LAG_INTERVAL = 0.5
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [count per bucket..., count above the last, sum]
+
+    def observe(self, value, *label_values):
+        if not METRICS_PORT:
+            return
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for label_values, series in list(self.series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                total += count
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, label_values, le)} {total}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, label_values)} {series[-1]}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, label_values)} {total}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms = []
+        self.gauges = []  # (name, help, fn, labels); fn returns a number or {label values: number}
+        self.stats = []  # (prefix, help, fn, labels); fn returns {key: number} or {label values: {key: number}}
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        histogram = Histogram(name, help_text, labels, buckets)
+        self.histograms.append(histogram)
+        return histogram
+
+    def gauge(self, name, help_text, fn, labels=()):
+        self.gauges.append((name, help_text, fn, labels))
+
+    def stats_dict(self, prefix, help_text, fn, labels=()):
+        # Exports each key of one of the existing stats dicts as prefix_key
+        self.stats.append((prefix, help_text, fn, labels))
+
+    def render(self):
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+        for name, help_text, fn, labels in self.gauges:
+            try:
+                value = fn()
+            except Exception as e:
+                print(f"Error collecting metric {name}: {e}")
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for label_values, v in (value.items() if labels else [((), value)]):
+                lines.append(f'{name}{format_labels(labels, label_values)} {v}')
+        for prefix, help_text, fn, labels in self.stats:
+            try:
+                series = fn() if labels else {(): fn()}
+            except Exception as e:
+                print(f"Error collecting metric {prefix}: {e}")
+                continue
+            by_key = {}
+            for label_values, values in series.items():
+                for key, v in values.items():
+                    by_key.setdefault(key, []).append((label_values, v))
+            for key, points in by_key.items():
+                lines.append(f'# HELP {prefix}_{key} {help_text}')
+                lines.append(f'# TYPE {prefix}_{key} untyped')
+                for label_values, v in points:
+                    lines.append(f'{prefix}_{key}{format_labels(labels, label_values)} {v}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+resolve_seconds = metrics.histogram('musicbot_resolve_seconds', 'Track resolution time by resolver cache result', ('cache',))
+first_audio_seconds = metrics.histogram('musicbot_first_audio_seconds', 'Time from a play command to its first audio packet')
+track_gap_seconds = metrics.histogram('musicbot_track_gap_seconds', 'Silence between the end of a track and the next one starting')
+playlist_flush_seconds = metrics.histogram('musicbot_playlist_flush_seconds', 'Time to write a batch of playlist changes')
+command_seconds = metrics.histogram('musicbot_command_seconds', 'Slash command latency from interaction creation', ('command', 'status'))
+loop_lag_seconds = metrics.histogram('musicbot_event_loop_lag_seconds', 'How late the event loop wakes a sleeping task',
+                                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+PLAYLIST_STORAGE = os.environ.get("PLAYLIST_STORAGE", "sqlite" if MULTI_PROCESS else "log")
+if MULTI_PROCESS and PLAYLIST_STORAGE != 'sqlite':
+    raise ValueError("Running a subset of shards needs PLAYLIST_STORAGE=sqlite")
+# IDs are reserved from the shared database this many at a time
+PLAYLIST_ID_BLOCK = int(os.environ.get("PLAYLIST_ID_BLOCK", "100"))
+PLAYLIST_LOG_COMPACT_OPS = int(os.environ.get("PLAYLIST_LOG_COMPACT_OPS", "1000"))
+PLAYLIST_WRITE_BEHIND = os.environ.get("PLAYLIST_WRITE_BEHIND", "1") == "1"
+PLAYLIST_FLUSH_INTERVAL = float(os.environ.get("PLAYLIST_FLUSH_INTERVAL", "2.0"))
+PLAYLIST_FLUSH_OPS = int(os.environ.get("PLAYLIST_FLUSH_OPS", "200"))
+# Guilds whose autocomplete index is kept in memory
+SEARCH_INDEX_GUILDS = int(os.environ.get("SEARCH_INDEX_GUILDS", "1000"))
+
+def empty_data():
+    return {"playlists": {}, "songs": {}, "next_id": 1}
+
+def write_json_atomic(path, obj, **kwargs):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def song_order_key(song):
+    return (song["rank"], song["id"])
+
+class SongOrder:
+    # Songs of one playlist ordered by a fractional "rank". Moving a song only
+    # changes its own rank, and positional lookups are O(log n).
+    def __init__(self, songs=()):
+        self.by_rank = SortedKeyList(key=song_order_key)
+        self.by_id = {}
+        for song in songs:
+            self.add(song)
+
+    def __len__(self):
+        return len(self.by_rank)
+
+    def __iter__(self):
+        return iter(self.by_rank)
+
+    def __getitem__(self, index):
+        return self.by_rank[index]
+
+    def add(self, song):
+        self.by_rank.add(song)
+        self.by_id[song["id"]] = song
+
+    def remove(self, song_id):
+        song = self.by_id.pop(song_id, None)
+        if song is not None:
+            self.by_rank.remove(song)
+        return song
+
+    def set_rank(self, song_id, rank):
+        song = self.by_id.get(song_id)
+        if song is not None:
+            self.by_rank.remove(song)
+            song["rank"] = rank
+            self.by_rank.add(song)
+
+    def last_rank(self):
+        return self.by_rank[-1]["rank"] if self.by_rank else 0.0
+
+    def rank_for_move(self, from_index, to_index):
+        # Rank that lands the song at from_index on to_index once moved, or
+        # None when float precision between the neighbours has run out
+        if to_index > from_index:
+            lo = self.by_rank[to_index]["rank"]
+            hi = self.by_rank[to_index + 1]["rank"] if to_index + 1 < len(self.by_rank) else None
+        else:
+            lo = self.by_rank[to_index - 1]["rank"] if to_index > 0 else None
+            hi = self.by_rank[to_index]["rank"]
+        if lo is None:
+            return hi - 1.0
+        if hi is None:
+            return lo + 1.0
+        rank = (lo + hi) / 2
+        return rank if lo < rank < hi else None
+
+def search_key(text):
+    return ' '.join(str(text or '').casefold().split())
+
+def trigrams(key):
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+# Entries looked at per query, so an autocomplete answers in time even when a
+# filter rejects most of a large guild
+SEARCH_SCAN_LIMIT = 5000
+
+class SearchIndex:
+    # Case-insensitive lookup over names and titles. The sorted keys answer
+    # prefix queries; trigram postings narrow substring queries down to a few
+    # candidates, which are then checked directly.
+    def __init__(self):
+        self.entries = {}  # entry_id -> (key, payload)
+        self.by_key = SortedList()  # (key, entry_id)
+        self.postings = {}  # trigram -> set of entry_ids
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry_id, text, payload):
+        self.remove(entry_id)
+        key = search_key(text)
+        self.entries[entry_id] = (key, payload)
+        self.by_key.add((key, entry_id))
+        for gram in trigrams(key):
+            self.postings.setdefault(gram, set()).add(entry_id)
+
+    def remove(self, entry_id):
+        entry = self.entries.pop(entry_id, None)
+        if entry is None:
+            return
+        self.by_key.remove((entry[0], entry_id))
+        for gram in trigrams(entry[0]):
+            ids = self.postings[gram]
+            ids.discard(entry_id)
+            if not ids:
+                del self.postings[gram]
+
+    def search(self, query, limit, accept=None):
+        # Prefix matches first, then other substring matches, each alphabetical
+        query = search_key(query)
+        results = []
+        seen = set()
+        for key, entry_id in itertools.islice(self.by_key.irange((query,)), SEARCH_SCAN_LIMIT):
+            if not key.startswith(query):
+                break
+            payload = self.entries[entry_id][1]
+            seen.add(entry_id)
+            if accept is None or accept(payload):
+                results.append(payload)
+                if len(results) >= limit:
+                    return results
+        grams = trigrams(query)
+        if not grams:
+            return results
+        postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:]) - seen
+        # Only the first SEARCH_SCAN_LIMIT candidates are looked at, so there's
+        # no need to sort the rest
+        matches = heapq.nsmallest(SEARCH_SCAN_LIMIT, ((self.entries[entry_id][0], entry_id) for entry_id in candidates))
+        for key, entry_id in matches:
+            payload = self.entries[entry_id][1]
+            if query in key and (accept is None or accept(payload)):
+                results.append(payload)
+                if len(results) >= limit:
+                    break
+        return results
+
+def prepare_data(data):
+    # Playlists are stored as a list but kept keyed by id, still in creation
+    # order. Turn the stored song lists into SongOrders. Rows written before
+    # ranks existed carry a 1-based "position" instead.
+    if isinstance(data["playlists"], list):
+        data["playlists"] = {p["id"]: p for p in data["playlists"]}
+    for playlist_id, songs in data["songs"].items():
+        if any("rank" not in s for s in songs):
+            songs = sorted(songs, key=lambda s: s.get("position", 0))
+            for i, s in enumerate(songs):
+                s["rank"] = float(i + 1)
+                s.pop("position", None)
+        data["songs"][playlist_id] = SongOrder(songs)
+    return data
+
+def export_data(data):
+    return {
+        "playlists": list(data["playlists"].values()),
+        "songs": {playlist_id: list(songs) for playlist_id, songs in data["songs"].items()},
+        "next_id": data["next_id"],
+    }
+
+def snapshot_data(data):
+    # Rows are flat, so copying each dict is enough for a snapshot that later
+    # edits can't reach while it is serialized outside the lock
+    return {
+        "playlists": {playlist_id: dict(p) for playlist_id, p in data["playlists"].items()},
+        "songs": {playlist_id: [dict(s) for s in songs] for playlist_id, songs in data["songs"].items()},
+        "next_id": data["next_id"],
+    }
+
+def apply_op(data, op):
+    kind = op[0]
+    if kind == 'set_next_id':
+        data["next_id"] = op[1]
+    elif kind == 'insert_playlist':
+        data["playlists"][op[1]["id"]] = op[1]
+        data["songs"].setdefault(str(op[1]["id"]), SongOrder())
+    elif kind == 'delete_playlist':
+        data["playlists"].pop(op[1], None)
+        data["songs"].pop(str(op[1]), None)
+    elif kind == 'insert_song':
+        songs = data["songs"].setdefault(str(op[1]["playlist_id"]), SongOrder())
+        if "rank" not in op[1]:
+            # Journals written before ranks always appended
+            op[1].pop("position", None)
+            op[1]["rank"] = songs.last_rank() + 1.0
+        songs.add(op[1])
+    elif kind == 'delete_song':
+        songs = data["songs"].get(str(op[1]))
+        if songs is not None:
+            songs.remove(op[2])
+    elif kind == 'set_song_rank':
+        songs = data["songs"].get(str(op[1]))
+        if songs is not None:
+            songs.set_rank(op[2], op[3])
+    elif kind == 'reorder_songs':
+        songs = data["songs"].get(str(op[1]))
+        if songs is not None:
+            ordered = [songs.by_id[song_id] for song_id in op[2] if song_id in songs.by_id]
+            for i, s in enumerate(ordered):
+                s["rank"] = float(i + 1)
+            data["songs"][str(op[1])] = SongOrder(ordered)
+    elif kind == 'set_song_gain':
+        songs = data["songs"].get(str(op[1]))
+        if songs is not None and op[2] in songs.by_id:
+            songs.by_id[op[2]]["gain_db"] = op[3]
+    else:
+        raise ValueError(f"Unknown playlist op: {kind}")
+
+def copy_op(op):
+    # Pending ops must not see later in-memory edits to the same rows
+    return tuple(dict(arg) if isinstance(arg, dict) else list(arg) if isinstance(arg, list) else arg for arg in op)
+
+# Storage backends receive commit(ops, data) where data is the full state
+# matching everything committed so far, or None while memory is ahead of the
+# storage (write-behind ops still pending) and a snapshot would be wrong.
+def files_size(*paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+class JSONFileStorage:
+    # Legacy format: the whole DB in one file, rewritten on every commit
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def size_bytes(self):
+        return files_size(self.path)
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            return prepare_data(json.load(f))
+
+    def needs_snapshot(self, n_ops):
+        return True
+
+    def commit(self, ops, data):
+        if data is not None:
+            write_json_atomic(self.path, export_data(data), indent=4)
+
+    def import_data(self, data):
+        write_json_atomic(self.path, export_data(data), indent=4)
+
+    def close(self):
+        pass
+
+class OpLogStorage:
+    # Append-only journal of committed op batches on top of a periodic snapshot.
+    # Every log line carries a sequence number so a crash between writing the
+    # snapshot and truncating the log never replays an op twice.
+    def __init__(self, base_path, compact_every=PLAYLIST_LOG_COMPACT_OPS):
+        self.snapshot_path = base_path + '.snapshot.json'
+        self.log_path = base_path + '.log'
+        self.compact_every = compact_every
+        self.seq = 0
+        self.log_ops = 0
+        self.log_file = None
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path) or os.path.exists(self.log_path)
+
+    def size_bytes(self):
+        return files_size(self.snapshot_path, self.log_path)
+
+    def load(self):
+        data = empty_data()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            data = prepare_data(snapshot["data"])
+            self.seq = snapshot["seq"]
+        if not os.path.exists(self.log_path):
+            return data
+        valid_end = 0
+        with open(self.log_path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete entry')
+                    entry = json.loads(line)
+                except ValueError:
+                    print(f"Ignoring torn entry at the end of {self.log_path}.")
+                    break
+                valid_end += len(line)
+                if entry["seq"] <= self.seq:
+                    continue
+                for op in entry["ops"]:
+                    apply_op(data, op)
+                self.seq = entry["seq"]
+                self.log_ops += len(entry["ops"])
+        if valid_end < os.path.getsize(self.log_path):
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(valid_end)
+        return data
+
+    def needs_snapshot(self, n_ops):
+        return self.log_ops + n_ops >= self.compact_every
+
+    def commit(self, ops, data):
+        if not ops:
+            return
+        if self.log_file is None:
+            self.log_file = open(self.log_path, 'a')
+        self.seq += 1
+        self.log_file.write(json.dumps({"seq": self.seq, "ops": ops}) + '\n')
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+        self.log_ops += len(ops)
+        if data is not None and self.log_ops >= self.compact_every:
+            self.compact(data)
+
+    def compact(self, data):
+        write_json_atomic(self.snapshot_path, {"seq": self.seq, "data": export_data(data)})
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        open(self.log_path, 'w').close()
+        self.log_ops = 0
+
+    def import_data(self, data):
+        self.compact(data)
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlists (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    guild_id TEXT NOT NULL,
+    is_public INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    playlist_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    title TEXT,
+    duration TEXT,
+    rank REAL NOT NULL,
+    gain_db REAL
+);
+CREATE INDEX IF NOT EXISTS songs_by_playlist ON songs (playlist_id, rank);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+class SQLiteStorage:
+    # Safe to share between processes: WAL lets readers run alongside the one
+    # writer and the busy timeout makes writers queue instead of failing
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        # The write-behind thread and reserve_ids share one connection
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def size_bytes(self):
+        return files_size(self.path, self.path + '-wal')
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(songs)')]
+            if 'position' in columns:
+                # Dense 1-based positions are valid ranks as they are
+                with self.conn:
+                    self.conn.execute('ALTER TABLE songs RENAME COLUMN position TO rank')
+            if columns and 'gain_db' not in columns:
+                with self.conn:
+                    self.conn.execute('ALTER TABLE songs ADD COLUMN gain_db REAL')
+            self.conn.executescript(SQLITE_SCHEMA)
+        return self.conn
+
+    def load(self):
+        conn = self.connect()
+        data = empty_data()
+        for row in conn.execute('SELECT id, name, user_id, guild_id, is_public, created_at FROM playlists ORDER BY id'):
+            data["playlists"][row[0]] = {
+                "id": row[0],
+                "name": row[1],
+                "user_id": row[2],
+                "guild_id": row[3],
+                "is_public": bool(row[4]),
+                "created_at": row[5]
+            }
+            data["songs"][str(row[0])] = []
+        for row in conn.execute('SELECT id, playlist_id, url, title, duration, rank, gain_db FROM songs'):
+            song = {
+                "id": row[0],
+                "playlist_id": row[1],
+                "url": row[2],
+                "title": row[3],
+                "duration": row[4],
+                "rank": float(row[5])
+            }
+            if row[6] is not None:
+                song["gain_db"] = row[6]
+            data["songs"].setdefault(str(row[1]), []).append(song)
+        row = conn.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+        if row:
+            data["next_id"] = int(row[0])
+        return prepare_data(data)
+
+    def needs_snapshot(self, n_ops):
+        return False
+
+    def commit(self, ops, data):
+        conn = self.connect()
+        with self.lock, conn:
+            for op in ops:
+                self.apply(conn, op)
+
+    def reserve_ids(self, count):
+        # IMMEDIATE takes the write lock up front, so two processes can't read
+        # the same next_id
+        conn = self.connect()
+        with self.lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+                start = int(row[0]) if row else 1
+                self.apply(conn, ('set_next_id', start + count))
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+        return start
+
+    def apply(self, conn, op):
+        kind = op[0]
+        if kind == 'set_next_id':
+            # Never moves backwards, so a process writing its own counter can't
+            # hand out IDs another process has reserved
+            conn.execute("INSERT INTO meta (key, value) VALUES ('next_id', ?) "
+                         "ON CONFLICT (key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+                         (str(op[1]),))
+        elif kind == 'insert_playlist':
+            p = op[1]
+            conn.execute('INSERT INTO playlists (id, name, user_id, guild_id, is_public, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                         (p["id"], p["name"], p["user_id"], p["guild_id"], int(p["is_public"]), p["created_at"]))
+        elif kind == 'delete_playlist':
+            conn.execute('DELETE FROM songs WHERE playlist_id = ?', (op[1],))
+            conn.execute('DELETE FROM playlists WHERE id = ?', (op[1],))
+        elif kind == 'insert_song':
+            s = op[1]
+            conn.execute('INSERT INTO songs (id, playlist_id, url, title, duration, rank, gain_db) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (s["id"], s["playlist_id"], s["url"], s["title"], s["duration"], s["rank"], s.get("gain_db")))
+        elif kind == 'delete_song':
+            conn.execute('DELETE FROM songs WHERE id = ?', (op[2],))
+        elif kind == 'set_song_rank':
+            conn.execute('UPDATE songs SET rank = ? WHERE id = ?', (op[3], op[2]))
+        elif kind == 'reorder_songs':
+            conn.executemany('UPDATE songs SET rank = ? WHERE id = ?', [(float(i + 1), song_id) for i, song_id in enumerate(op[2])])
+        elif kind == 'set_song_gain':
+            conn.execute('UPDATE songs SET gain_db = ? WHERE id = ?', (op[3], op[2]))
+        else:
+            raise ValueError(f"Unknown playlist op: {kind}")
+
+    def import_data(self, data):
+        conn = self.connect()
+        with self.lock, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'next_id'").fetchone():
+                # Another process sharing the database got here first
+                return
+            self.apply(conn, ('set_next_id', data["next_id"]))
+            for p in data["playlists"].values():
+                self.apply(conn, ('insert_playlist', p))
+            for songs in data["songs"].values():
+                for s in songs:
+                    self.apply(conn, ('insert_song', s))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+def create_storage(kind, db_path):
+    base_path = os.path.splitext(db_path)[0]
+    if kind == 'json':
+        return JSONFileStorage(db_path)
+    if kind == 'log':
+        return OpLogStorage(base_path)
+    if kind == 'sqlite':
+        return SQLiteStorage(base_path + '.db')
+    raise ValueError(f"Unknown PLAYLIST_STORAGE: {kind}")
+
 class PlaylistDB:
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, storage=None, write_behind=PLAYLIST_WRITE_BEHIND, shared=MULTI_PROCESS, load=True):
         if db_path is None:
             db_path = os.path.join(DATA_DIR, 'playlists.json')
         self.db_path = db_path
-        self.data = {"playlists": [], "songs": {}, "next_id": 1}
-        self.load_data()
+        self.storage = storage or create_storage(PLAYLIST_STORAGE, db_path)
+        self.data = empty_data()
+        # Other processes write to the same storage, so IDs come from reserve_ids
+        self.shared = shared
+        self.id_block_end = 0
+        # Held while memory is mutated and while write_batch copies self.data
+        self.lock = threading.Lock()
+        self.write_behind = write_behind
+        self.pending = []
+        self.dirty = asyncio.Event()
+        self.full = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.stats = {
+            "flushes": 0,
+            "flush_errors": 0,
+            "ops_flushed": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_seconds": 0.0,
+            "max_flush_seconds": 0.0,
+            "total_flush_seconds": 0.0,
+        }
+        # Called with the records of newly added songs
+        self.on_songs_added = None
+        # guild_id -> (playlist SearchIndex, song SearchIndex), built on first search
+        self.search_indexes = OrderedDict()
+        # With load=False the data is read by ensure_loaded() instead
+        self.load_task = None
+        self.loaded = False
+        if load:
+            self.load_data()
+
+    async def ensure_loaded(self):
+        if self.loaded:
+            return
+        if self.load_task is None:
+            self.load_task = asyncio.ensure_future(asyncio.to_thread(self.load_data))
+        await asyncio.shield(self.load_task)
 
     def load_data(self):
-        if os.path.exists(self.db_path):
-            try:
-                with open(self.db_path, 'r') as f:
-                    self.data = json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                print(f"Error loading JSON data: {e}. Starting with empty data.")
-                self.data = {"playlists": [], "songs": {}, "next_id": 1}
+        started = time.perf_counter()
+        self.load_storage()
+        if self.shared:
+            # Guilds on other shards are served, and written, by other processes
+            self.data["playlists"] = {playlist_id: p for playlist_id, p in self.data["playlists"].items() if owns_guild(p["guild_id"])}
+            self.data["songs"] = {str(playlist_id): self.data["songs"][str(playlist_id)] for playlist_id in self.data["playlists"]}
+        self.rebuild_indexes()
+        self.loaded = True
+        self.load_seconds = time.perf_counter() - started
 
-    def save_data(self):
+    def load_storage(self):
+        if not isinstance(self.storage, JSONFileStorage) and not self.storage.exists() and os.path.exists(self.db_path):
+            self.migrate_legacy_json()
+        if not self.storage.exists():
+            return
         try:
-            with open(self.db_path, 'w') as f:
-                json.dump(self.data, f, indent=4)
-        except IOError as e:
-            print(f"Error saving JSON data: {e}")
+            self.data = self.storage.load()
+        except (ValueError, KeyError, IOError, sqlite3.Error) as e:
+            print(f"Error loading playlist data: {e}. Starting with empty data.")
+            self.data = empty_data()
+
+    def migrate_legacy_json(self):
+        try:
+            data = JSONFileStorage(self.db_path).load()
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error loading JSON data for migration: {e}. Leaving it in place.")
+            return
+        self.storage.import_data(data)
+        try:
+            os.replace(self.db_path, self.db_path + '.migrated')
+        except FileNotFoundError:
+            # Already moved by another process sharing the database
+            return
+        print(f"Migrated {len(data['playlists'])} playlists from {self.db_path} to {type(self.storage).__name__}.")
+
+    def rebuild_indexes(self):
+        self.search_indexes = OrderedDict()
+        self.playlists_by_id = {}
+        self.private_by_name = {}  # (guild_id, user_id, name) -> playlist
+        self.public_by_name = {}  # (guild_id, name) -> playlist
+        self.playlists_by_guild = {}  # guild_id -> {playlist_id: playlist}, in creation order
+        for p in self.data["playlists"].values():
+            self.index_playlist(p)
+
+    def index_playlist(self, p):
+        self.playlists_by_id[p["id"]] = p
+        if p["is_public"]:
+            self.public_by_name[(p["guild_id"], p["name"])] = p
+        else:
+            self.private_by_name[(p["guild_id"], p["user_id"], p["name"])] = p
+        self.playlists_by_guild.setdefault(p["guild_id"], {})[p["id"]] = p
+        indexes = self.search_indexes.get(p["guild_id"])
+        if indexes is not None:
+            indexes[0].add(p["id"], p["name"], p)
+
+    def unindex_playlist(self, p):
+        indexes = self.search_indexes.get(p["guild_id"])
+        if indexes is not None:
+            indexes[0].remove(p["id"])
+            for song in self.data["songs"].get(str(p["id"]), ()):
+                indexes[1].remove(song["id"])
+        self.playlists_by_id.pop(p["id"], None)
+        if p["is_public"]:
+            self.public_by_name.pop((p["guild_id"], p["name"]), None)
+        else:
+            self.private_by_name.pop((p["guild_id"], p["user_id"], p["name"]), None)
+        guild_playlists = self.playlists_by_guild.get(p["guild_id"])
+        if guild_playlists is not None:
+            guild_playlists.pop(p["id"], None)
+            if not guild_playlists:
+                del self.playlists_by_guild[p["guild_id"]]
+
+    def index_song(self, song):
+        p = self.playlists_by_id.get(song["playlist_id"])
+        indexes = self.search_indexes.get(p["guild_id"]) if p else None
+        if indexes is not None:
+            indexes[1].add(song["id"], song["title"] or song["url"], song)
+
+    def unindex_song(self, playlist_id, song_id):
+        p = self.playlists_by_id.get(playlist_id)
+        indexes = self.search_indexes.get(p["guild_id"]) if p else None
+        if indexes is not None:
+            indexes[1].remove(song_id)
+
+    def search_indexes_for(self, guild_id):
+        # Only guilds that actually search pay for an index; mutations keep
+        # the built ones current
+        indexes = self.search_indexes.get(guild_id)
+        if indexes is not None:
+            self.search_indexes.move_to_end(guild_id)
+            return indexes
+        indexes = (SearchIndex(), SearchIndex())
+        for p in self.playlists_by_guild.get(guild_id, {}).values():
+            indexes[0].add(p["id"], p["name"], p)
+            for song in self.data["songs"].get(str(p["id"]), ()):
+                indexes[1].add(song["id"], song["title"] or song["url"], song)
+        self.search_indexes[guild_id] = indexes
+        while len(self.search_indexes) > SEARCH_INDEX_GUILDS:
+            self.search_indexes.popitem(last=False)
+        return indexes
+
+    def search_playlists(self, guild_id, query, limit, accept=None):
+        return self.search_indexes_for(guild_id)[0].search(query, limit, accept)
+
+    def search_songs(self, guild_id, query, limit, accept=None):
+        return self.search_indexes_for(guild_id)[1].search(query, limit, accept)
+
+    def commit(self, ops):
+        with self.lock:
+            for op in ops:
+                if op[0] == 'delete_playlist' and op[1] in self.playlists_by_id:
+                    self.unindex_playlist(self.playlists_by_id[op[1]])
+                elif op[0] == 'delete_song':
+                    self.unindex_song(op[1], op[2])
+                apply_op(self.data, op)
+                if op[0] == 'insert_playlist':
+                    self.index_playlist(op[1])
+                elif op[0] == 'insert_song':
+                    self.index_song(op[1])
+            if self.write_behind:
+                # Queued under the same lock, so a snapshot taken by write_batch
+                # never holds an op that pending doesn't
+                self.pending.extend(copy_op(op) for op in ops)
+                self.dirty.set()
+                if len(self.pending) >= PLAYLIST_FLUSH_OPS:
+                    self.full.set()
+        if not self.write_behind:
+            self.write_batch(ops)
+
+    def write_batch(self, ops):
+        start = time.perf_counter()
+        try:
+            snapshot = None
+            if self.storage.needs_snapshot(len(ops)):
+                # Only the copy happens under the lock; serializing and fsyncing
+                # it must not stall commit() on the event loop
+                with self.lock:
+                    if not self.pending:
+                        snapshot = snapshot_data(self.data)
+            self.storage.commit(ops, snapshot)
+        except (IOError, sqlite3.Error) as e:
+            self.stats["flush_errors"] += 1
+            print(f"Error saving playlist data: {e}")
+            return False
+        elapsed = time.perf_counter() - start
+        playlist_flush_seconds.observe(elapsed)
+        self.stats["flushes"] += 1
+        self.stats["ops_flushed"] += len(ops)
+        self.stats["last_batch_size"] = len(ops)
+        self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(ops))
+        self.stats["last_flush_seconds"] = elapsed
+        self.stats["max_flush_seconds"] = max(self.stats["max_flush_seconds"], elapsed)
+        self.stats["total_flush_seconds"] += elapsed
+        return True
+
+    async def flush(self):
+        async with self.flush_lock:
+            self.dirty.clear()
+            self.full.clear()
+            ops, self.pending = self.pending, []
+            if not ops:
+                return
+            if not await asyncio.to_thread(self.write_batch, ops):
+                # Keep them for the next round rather than dropping writes
+                self.pending[:0] = ops
+                self.dirty.set()
+
+    async def write_behind_loop(self):
+        while True:
+            await self.dirty.wait()
+            try:
+                await asyncio.wait_for(self.full.wait(), PLAYLIST_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start_write_behind(self):
+        if self.write_behind and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.write_behind_loop())
+
+    def close(self):
+        # Runs after the event loop is gone, so flush whatever is left inline
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        ops, self.pending = self.pending, []
+        if ops and not self.write_batch(ops):
+            print(f"Lost {len(ops)} playlist changes on shutdown.")
+        self.storage.close()
 
     def get_next_id(self):
+        if self.shared and self.data["next_id"] >= self.id_block_end:
+            self.data["next_id"] = self.storage.reserve_ids(PLAYLIST_ID_BLOCK)
+            self.id_block_end = self.data["next_id"] + PLAYLIST_ID_BLOCK
         id_ = self.data["next_id"]
         self.data["next_id"] += 1
-        self.save_data()
         return id_
 
     def create_new_playlist(self, name, user_id, guild_id):
-        for p in self.data["playlists"]:
-            if p["name"] == name and p["user_id"] == user_id and p["guild_id"] == guild_id:
-                return {'success': False, 'error': 'Playlist name already exists'}
+        # A public playlist the user owns also blocks the name
+        public = self.public_by_name.get((guild_id, name))
+        if (guild_id, user_id, name) in self.private_by_name or (public and public["user_id"] == user_id):
+            return {'success': False, 'error': 'Playlist name already exists'}
         playlist = {
             "id": self.get_next_id(),
             "name": name,
@@ -83,15 +974,12 @@ class PlaylistDB:
             "is_public": False,
             "created_at": datetime.now().isoformat()
         }
-        self.data["playlists"].append(playlist)
-        self.data["songs"][str(playlist["id"])] = []
-        self.save_data()
+        self.commit([('set_next_id', self.data["next_id"]), ('insert_playlist', playlist)])
         return {'success': True}
 
     def create_new_public_playlist(self, name, user_id, guild_id):
-        for p in self.data["playlists"]:
-            if p["name"] == name and p["guild_id"] == guild_id and p["is_public"]:
-                return {'success': False, 'error': 'Public playlist name already exists'}
+        if (guild_id, name) in self.public_by_name:
+            return {'success': False, 'error': 'Public playlist name already exists'}
         playlist = {
             "id": self.get_next_id(),
             "name": name,
@@ -100,205 +988,1661 @@ class PlaylistDB:
             "is_public": True,
             "created_at": datetime.now().isoformat()
         }
-        self.data["playlists"].append(playlist)
-        self.data["songs"][str(playlist["id"])] = []
-        self.save_data()
+        self.commit([('set_next_id', self.data["next_id"]), ('insert_playlist', playlist)])
         return {'success': True}
 
     def get_playlist_by_name(self, name, user_id, guild_id):
-        for p in self.data["playlists"]:
-            if p["name"] == name and p["user_id"] == user_id and p["guild_id"] == guild_id and not p["is_public"]:
-                return p
-        return None
+        return self.private_by_name.get((guild_id, user_id, name))
 
     def get_public_playlist_by_name(self, name, guild_id):
-        for p in self.data["playlists"]:
-            if p["name"] == name and p["guild_id"] == guild_id and p["is_public"]:
-                return p
-        return None
+        return self.public_by_name.get((guild_id, name))
 
     def get_user_playlists_in_guild(self, user_id, guild_id):
-        return [p for p in self.data["playlists"] if p["user_id"] == user_id and p["guild_id"] == guild_id and not p["is_public"]]
+        return [p for p in self.playlists_by_guild.get(guild_id, {}).values() if p["user_id"] == user_id and not p["is_public"]]
 
     def get_public_playlists_in_guild(self, guild_id):
-        return [p for p in self.data["playlists"] if p["guild_id"] == guild_id and p["is_public"]]
+        return [p for p in self.playlists_by_guild.get(guild_id, {}).values() if p["is_public"]]
+
+    def get_playlists_in_guild(self, guild_id):
+        return list(self.playlists_by_guild.get(guild_id, {}).values())
 
     def add_song(self, playlist_id, url, title, duration):
         if str(playlist_id) not in self.data["songs"]:
             return {'success': False, 'error': 'Playlist not found'}
         songs = self.data["songs"][str(playlist_id)]
-        position = len(songs) + 1
         song = {
             "id": self.get_next_id(),
             "playlist_id": playlist_id,
             "url": url,
             "title": title,
             "duration": duration,
-            "position": position
+            "rank": songs.last_rank() + 1.0
         }
-        songs.append(song)
-        self.save_data()
+        self.commit([('set_next_id', self.data["next_id"]), ('insert_song', song)])
+        if self.on_songs_added:
+            self.on_songs_added([song])
         return {'success': True}
 
-    def get_songs(self, playlist_id):
-        return sorted(self.data["songs"].get(str(playlist_id), []), key=lambda s: s["position"])
+    def add_songs(self, playlist_id, tracks):
+        # Bulk insert of (url, title, duration) rows as a single commit
+        if str(playlist_id) not in self.data["songs"]:
+            return {'success': False, 'error': 'Playlist not found'}
+        rank = self.data["songs"][str(playlist_id)].last_rank()
+        ops = []
+        for url, title, duration in tracks:
+            rank += 1.0
+            ops.append(('insert_song', {
+                "id": self.get_next_id(),
+                "playlist_id": playlist_id,
+                "url": url,
+                "title": title,
+                "duration": duration,
+                "rank": rank
+            }))
+        ops.append(('set_next_id', self.data["next_id"]))
+        self.commit(ops)
+        if self.on_songs_added:
+            self.on_songs_added([op[1] for op in ops if op[0] == 'insert_song'])
+        return {'success': True, 'added': len(tracks)}
+
+    def get_songs(self, playlist_id, limit=None, offset=0):
+        songs = self.data["songs"].get(str(playlist_id))
+        if songs is None:
+            return []
+        return songs[offset:None if limit is None else offset + limit]
+
+    def count_songs(self, playlist_id):
+        return len(self.data["songs"].get(str(playlist_id), ()))
+
+    def get_song_at(self, playlist_id, position):
+        songs = self.data["songs"].get(str(playlist_id))
+        if songs is None or position < 1 or position > len(songs):
+            return None
+        return songs[position - 1]
+
+    def get_song_position(self, playlist_id, song_id):
+        songs = self.data["songs"].get(str(playlist_id))
+        if songs is None or song_id not in songs.by_id:
+            return None
+        return songs.by_rank.index(songs.by_id[song_id]) + 1
 
     def remove_playlist(self, playlist_id, user_id):
-        for p in self.data["playlists"]:
-            if p["id"] == playlist_id and p["user_id"] == user_id:
-                self.data["playlists"].remove(p)
-                self.data["songs"].pop(str(playlist_id), None)
-                self.save_data()
-                return {'success': True, 'deleted': True}
+        p = self.playlists_by_id.get(playlist_id)
+        if p and p["user_id"] == user_id:
+            self.commit([('delete_playlist', playlist_id)])
+            return {'success': True, 'deleted': True}
         return {'success': False}
 
     def remove_song_from_playlist(self, playlist_id, song_id):
-        songs = self.data["songs"].get(str(playlist_id), [])
-        for s in songs:
-            if s["id"] == song_id:
-                songs.remove(s)
-                # Reassign positions
-                for i, s in enumerate(songs):
-                    s["position"] = i + 1
-                self.save_data()
-                return {'success': True}
-        return {'success': False}
+        songs = self.data["songs"].get(str(playlist_id))
+        if songs is None or song_id not in songs.by_id:
+            return {'success': False}
+        self.commit([('delete_song', playlist_id, song_id)])
+        return {'success': True}
 
     def move_song_in_playlist(self, playlist_id, from_pos, to_pos):
-        songs = self.data["songs"].get(str(playlist_id), [])
-        if from_pos < 1 or from_pos > len(songs) or to_pos < 1 or to_pos > len(songs):
+        songs = self.data["songs"].get(str(playlist_id))
+        if songs is None or from_pos < 1 or from_pos > len(songs) or to_pos < 1 or to_pos > len(songs):
             return {'success': False}
         song = songs[from_pos - 1]
-        songs.remove(song)
-        songs.insert(to_pos - 1, song)
-        # Reassign positions
-        for i, s in enumerate(songs):
-            s["position"] = i + 1
-        self.save_data()
+        rank = songs.rank_for_move(from_pos - 1, to_pos - 1)
+        if rank is not None:
+            self.commit([('set_song_rank', playlist_id, song["id"], rank)])
+            return {'success': True}
+        # Out of room between the neighbours; renumber the whole playlist once
+        order = [s["id"] for s in songs]
+        order.insert(to_pos - 1, order.pop(from_pos - 1))
+        self.commit([('reorder_songs', playlist_id, order)])
         return {'success': True}
 
     def shuffle_playlist(self, playlist_id):
         import random
-        songs = self.data["songs"].get(str(playlist_id), [])
-        random.shuffle(songs)
-        for i, s in enumerate(songs):
-            s["position"] = i + 1
-        self.save_data()
+        order = [s["id"] for s in self.data["songs"].get(str(playlist_id), ())]
+        random.shuffle(order)
+        self.commit([('reorder_songs', playlist_id, order)])
         return {'success': True}
 
-db = PlaylistDB()
+    def set_song_gain(self, playlist_id, song_id, gain_db):
+        songs = self.data["songs"].get(str(playlist_id))
+        if songs is None or song_id not in songs.by_id:
+            return {'success': False}
+        self.commit([('set_song_gain', playlist_id, song_id, gain_db)])
+        return {'success': True}
+
+db = PlaylistDB(load=False)
+
+YTDL_OPTS = {
+    'format': 'bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'noplaylist': True,
+    'ffmpeg_location': 'ffmpeg',
+}
+
+RESOLVER_CACHE_SIZE = int(os.environ.get("RESOLVER_CACHE_SIZE", "5000"))
+RESOLVER_METADATA_TTL = int(os.environ.get("RESOLVER_METADATA_TTL", str(7 * 24 * 3600)))
+# Failed extractions are remembered this long so broken links aren't retried in a loop
+RESOLVER_NEGATIVE_TTL = int(os.environ.get("RESOLVER_NEGATIVE_TTL", "60"))
+# Stream URLs must stay valid for a whole track (max 600s) plus ffmpeg reconnects
+STREAM_EXPIRY_MARGIN = 900
+STREAM_DEFAULT_TTL = 1800
+
+YOUTUBE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+def normalize_video_id(url):
+    try:
+        parsed = urlparse(url.strip())
+    except ValueError:
+        return None
+    host = (parsed.hostname or '').lower()
+    for prefix in ('www.', 'm.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    candidate = None
+    if host == 'youtu.be':
+        candidate = parsed.path.strip('/').split('/')[0]
+    elif host in ('youtube.com', 'youtube-nocookie.com'):
+        if parsed.path == '/watch':
+            candidate = parse_qs(parsed.query).get('v', [''])[0]
+        else:
+            parts = parsed.path.strip('/').split('/')
+            if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v'):
+                candidate = parts[1]
+    if candidate and YOUTUBE_ID_RE.match(candidate):
+        return candidate
+    return None
+
+def stream_url_expiry(stream_url):
+    parsed = urlparse(stream_url)
+    expire = parse_qs(parsed.query).get('expire')
+    if not expire:
+        # Manifest URLs carry their parameters in the path (/expire/<ts>/...)
+        match = re.search(r'/expire/(\d+)', parsed.path)
+        expire = [match.group(1)] if match else None
+    try:
+        return int(expire[0]) if expire else time.time() + STREAM_DEFAULT_TTL
+    except ValueError:
+        return time.time() + STREAM_DEFAULT_TTL
+
+class ResolverCache:
+    def __init__(self, cache_path=None, max_entries=RESOLVER_CACHE_SIZE):
+        if cache_path is None:
+            cache_path = os.path.join(DATA_DIR, f'resolver_cache{PROCESS_SUFFIX}.json')
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                entries = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error loading resolver cache: {e}. Starting cold.")
+            return
+        now = time.time()
+        for key, entry in entries:
+            if now - entry["cached_at"] < RESOLVER_METADATA_TTL:
+                self.entries[key] = entry
+        self._evict()
+
+    def save(self):
+        # Snapshot on the caller's thread; the dump itself can run in a worker
+        snapshot = list(self.entries.items())
+        self.dirty = False
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.cache_path)
+        except IOError as e:
+            self.dirty = True
+            print(f"Error saving resolver cache: {e}")
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key, need_stream=True):
+        entry = self.entries.get(key)
+        now = time.time()
+        if entry is None or now - entry["cached_at"] >= RESOLVER_METADATA_TTL:
+            self.misses += 1
+            return None
+        if need_stream and (not entry.get("stream_url") or entry["expires_at"] - now < STREAM_EXPIRY_MARGIN):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, info):
+        stream_url = info.get('url')
+        entry = {
+            "title": info.get('title'),
+            "duration": info.get('duration'),
+            "duration_string": info.get('duration_string', ''),
+            "webpage_url": info.get('webpage_url'),
+            "stream_url": stream_url,
+            "expires_at": stream_url_expiry(stream_url) if stream_url else 0,
+            "acodec": info.get('acodec'),
+            "asr": info.get('asr'),
+            "cached_at": time.time(),
+        }
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self._evict()
+        self.dirty = True
+        return entry
+
+# "process" runs yt_dlp in long-lived worker processes (extract_worker.py) so its
+# CPU-heavy parsing doesn't hold the GIL the gateway and voice threads need
+EXTRACT_MODE = os.environ.get("EXTRACT_MODE", "thread")
+EXTRACT_TIMEOUT = int(os.environ.get("EXTRACT_TIMEOUT", "60"))
+# Worker processes are replaced after this many extractions to cap memory growth
+EXTRACT_PROCESS_MAX_JOBS = int(os.environ.get("EXTRACT_PROCESS_MAX_JOBS", "500"))
+EXTRACT_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extract_worker.py')
+
+class ExtractionFailed(Exception):
+    pass
+
+class ExtractProcess:
+    # One warm worker process, used by a single extraction thread at a time
+    def __init__(self, stats):
+        self.proc = None
+        self.jobs = 0
+        self.stats = stats
+
+    def start(self):
+        self.proc = subprocess.Popen([sys.executable, EXTRACT_WORKER_SCRIPT],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        # Replies are read straight off the descriptor by read_reply
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        self.jobs = 0
+        self.stats["spawned"] += 1
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def call(self, opts, url, timeout):
+        if self.proc is None or self.proc.poll() is not None or self.jobs >= EXTRACT_PROCESS_MAX_JOBS:
+            self.stop()
+            self.start()
+        self.jobs += 1
+        try:
+            self.proc.stdin.write(json.dumps({'opts': opts, 'url': url}) + '\n')
+            self.proc.stdin.flush()
+            line = self.read_reply(time.monotonic() + timeout)
+        except OSError:
+            line = ''
+        if line is None:
+            # A hung extraction can't be interrupted, only killed
+            self.stats["timeouts"] += 1
+            self.stop()
+            raise ExtractionFailed(f'Extraction timed out after {timeout}s')
+        if not line:
+            self.stats["crashes"] += 1
+            self.stop()
+            raise ExtractionFailed('Extractor process exited unexpectedly')
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise ExtractionFailed(reply['error'])
+        return reply['info']
+
+    def read_reply(self, deadline):
+        # A worker that hangs halfway through a line would block readline()
+        # past the timeout, so collect chunks until the newline instead.
+        # Returns None on timeout and '' if the worker exited.
+        fd = self.proc.stdout.fileno()
+        chunks = []
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                return None
+            try:
+                chunk = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                return ''
+            chunks.append(chunk)
+            if chunk.endswith(b'\n'):
+                return b''.join(chunks).decode()
+
+class ExtractProcessPool:
+    # Processes start on first use; the scheduler never runs more calls at once
+    # than there are processes
+    def __init__(self, size):
+        self.stats = {"spawned": 0, "timeouts": 0, "crashes": 0}
+        self.workers = [ExtractProcess(self.stats) for _ in range(size)]
+        self.idle = list(self.workers)
+        self.lock = threading.Lock()
+
+    def extract(self, opts, url, timeout=EXTRACT_TIMEOUT):
+        with self.lock:
+            worker = self.idle.pop()
+        try:
+            return worker.call(opts, url, timeout)
+        finally:
+            with self.lock:
+                self.idle.append(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+yt_dlp = None
+
+def load_yt_dlp():
+    # Importing yt_dlp takes a good part of a second, and process mode never
+    # needs it in this process
+    global yt_dlp
+    if yt_dlp is None:
+        started = time.perf_counter()
+        import yt_dlp as module
+        yt_dlp = module
+        mark_startup('yt_dlp import', started)
+    return yt_dlp
+
+def extract_info(url):
+    if process_pool is not None:
+        return process_pool.extract(YTDL_OPTS, url)
+    with load_yt_dlp().YoutubeDL(YTDL_OPTS) as ydl:
+        return ydl.extract_info(url, download=False)
+
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", "4"))
+# Most extractions one guild may have running at once, so it can't take every worker
+EXTRACT_GUILD_CAP = int(os.environ.get("EXTRACT_GUILD_CAP", str(max(1, EXTRACT_WORKERS // 2))))
+# Jobs beyond this many waiting are rejected straight away instead of queueing for minutes
+EXTRACT_QUEUE_LIMIT = int(os.environ.get("EXTRACT_QUEUE_LIMIT", "200"))
+
+PRIORITY_PLAY = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = ('play', 'prefetch', 'bulk')
+
+class ExtractorBusy(Exception):
+    pass
+
+class ExtractionJob:
+    def __init__(self, fn, args, priority, guild_id):
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.guild_id = guild_id
+        self.future = asyncio.get_running_loop().create_future()
+        self.submitted_at = time.monotonic()
+
+class ExtractionScheduler:
+    # yt_dlp calls run on their own pool instead of the loop's default executor.
+    # Waiting jobs are served strictly by priority class, and round-robin across
+    # guilds within a class.
+    def __init__(self, workers=EXTRACT_WORKERS, guild_cap=EXTRACT_GUILD_CAP, queue_limit=EXTRACT_QUEUE_LIMIT):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='extract')
+        self.workers = workers
+        self.guild_cap = guild_cap
+        self.queue_limit = queue_limit
+        self.waiting = [OrderedDict() for _ in PRIORITY_NAMES]  # per class: guild_id -> deque of jobs
+        self.waiting_count = 0
+        self.running = 0
+        self.running_by_guild = {}
+        self.stats = {name: {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0,
+                             "wait_seconds": 0.0, "max_wait_seconds": 0.0, "run_seconds": 0.0}
+                      for name in PRIORITY_NAMES}
+
+    def submit(self, fn, *args, priority=PRIORITY_PLAY, guild_id=None):
+        stats = self.stats[PRIORITY_NAMES[priority]]
+        if self.waiting_count >= self.queue_limit:
+            stats["rejected"] += 1
+            raise ExtractorBusy('Too many lookups are queued right now, try again in a moment')
+        stats["submitted"] += 1
+        job = ExtractionJob(fn, args, priority, guild_id)
+        self.waiting[priority].setdefault(guild_id, deque()).append(job)
+        self.waiting_count += 1
+        self.dispatch()
+        return job
+
+    async def run(self, fn, *args, priority=PRIORITY_PLAY, guild_id=None):
+        return await self.submit(fn, *args, priority=priority, guild_id=guild_id).future
+
+    def promote(self, job, priority):
+        # A more urgent caller is waiting on a job that hasn't started yet
+        queue = self.waiting[job.priority].get(job.guild_id)
+        if priority >= job.priority or queue is None or job not in queue:
+            return
+        queue.remove(job)
+        if not queue:
+            del self.waiting[job.priority][job.guild_id]
+        job.priority = priority
+        self.waiting[priority].setdefault(job.guild_id, deque()).append(job)
+        self.dispatch()
+
+    def next_job(self):
+        for queues in self.waiting:
+            for guild_id in list(queues):
+                if self.running_by_guild.get(guild_id, 0) >= self.guild_cap:
+                    continue
+                queue = queues[guild_id]
+                job = queue.popleft()
+                if queue:
+                    queues.move_to_end(guild_id)
+                else:
+                    del queues[guild_id]
+                return job
+        return None
+
+    def dispatch(self):
+        while self.running < self.workers:
+            job = self.next_job()
+            if job is None:
+                return
+            self.waiting_count -= 1
+            if not job.future.cancelled():
+                self.start(job)
+
+    def start(self, job):
+        started_at = time.monotonic()
+        stats = self.stats[PRIORITY_NAMES[job.priority]]
+        wait = started_at - job.submitted_at
+        stats["wait_seconds"] += wait
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], wait)
+        self.running += 1
+        self.running_by_guild[job.guild_id] = self.running_by_guild.get(job.guild_id, 0) + 1
+        run = asyncio.get_running_loop().run_in_executor(self.executor, job.fn, *job.args)
+        run.add_done_callback(lambda run: self.finish(job, run, started_at))
+
+    def finish(self, job, run, started_at):
+        stats = self.stats[PRIORITY_NAMES[job.priority]]
+        stats["run_seconds"] += time.monotonic() - started_at
+        self.running -= 1
+        self.running_by_guild[job.guild_id] -= 1
+        if not self.running_by_guild[job.guild_id]:
+            del self.running_by_guild[job.guild_id]
+        if run.cancelled():
+            job.future.cancel()
+        elif run.exception() is not None:
+            stats["failed"] += 1
+            if not job.future.cancelled():
+                job.future.set_exception(run.exception())
+        else:
+            stats["completed"] += 1
+            if not job.future.cancelled():
+                job.future.set_result(run.result())
+        self.dispatch()
+
+class TrackResolver:
+    def __init__(self, cache, extractor):
+        self.cache = cache
+        self.extractor = extractor
+        self.inflight = {}  # key -> (task, job) shared by every concurrent caller
+        self.failures = {}  # key -> (retry_after, exception)
+        self.coalesced = 0
+        self.negative_hits = 0
+
+    @staticmethod
+    def cache_key(url):
+        return normalize_video_id(url) or url
+
+    @staticmethod
+    def to_info(key, entry):
+        # Same keys the command handlers read from a yt_dlp info dict; 'id' is
+        # the cache key, which resolve() also accepts in place of the URL
+        return {
+            'id': key,
+            'title': entry["title"],
+            'duration': entry["duration"],
+            'duration_string': entry["duration_string"],
+            'webpage_url': entry["webpage_url"],
+            'url': entry["stream_url"],
+            'acodec': entry.get("acodec"),
+            'asr': entry.get("asr"),
+        }
+
+    async def resolve(self, url, need_stream=True, priority=PRIORITY_PLAY, guild_id=None):
+        start = time.perf_counter()
+        key = self.cache_key(url)
+        entry = self.cache.get(key, need_stream=need_stream)
+        if entry is None:
+            entry = await self.extract(key, url, priority, guild_id)
+            resolve_seconds.observe(time.perf_counter() - start, 'miss')
+        else:
+            resolve_seconds.observe(time.perf_counter() - start, 'hit')
+        return self.to_info(key, entry)
+
+    async def extract(self, key, url, priority, guild_id):
+        failure = self.failures.get(key)
+        if failure is not None:
+            if time.monotonic() < failure[0]:
+                self.negative_hits += 1
+                raise failure[1]
+            del self.failures[key]
+        inflight = self.inflight.get(key)
+        if inflight is None:
+            job = self.extractor.submit(extract_info, url, priority=priority, guild_id=guild_id)
+            task = asyncio.create_task(self._extract(key, job))
+            # Keeps a failure quiet if every caller was cancelled before it finished
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self.inflight[key] = (task, job)
+        else:
+            task, job = inflight
+            self.coalesced += 1
+            self.extractor.promote(job, priority)
+        # Shielded so one caller being cancelled doesn't cancel the others' result
+        return await asyncio.shield(task)
+
+    async def _extract(self, key, job):
+        try:
+            info = await job.future
+        except Exception as e:
+            now = time.monotonic()
+            if len(self.failures) >= RESOLVER_CACHE_SIZE:
+                self.failures = {k: f for k, f in self.failures.items() if f[0] > now}
+            self.failures[key] = (now + RESOLVER_NEGATIVE_TTL, e)
+            raise
+        finally:
+            del self.inflight[key]
+        return self.cache.put(key, info)
+
+resolver_cache = ResolverCache()
+extractor = ExtractionScheduler()
+process_pool = ExtractProcessPool(EXTRACT_WORKERS) if EXTRACT_MODE == 'process' else None
+resolver = TrackResolver(resolver_cache, extractor)
+
+AUDIO_CACHE_MAX_MB = int(os.environ.get("AUDIO_CACHE_MAX_MB", "0"))
+AUDIO_CACHE_MIN_PLAYS = int(os.environ.get("AUDIO_CACHE_MIN_PLAYS", "3"))
+AUDIO_CACHE_TRACKED = 20000
+AUDIO_CACHE_DOWNLOAD_TIMEOUT = 300
+# Files handed to ffmpeg within this window are never evicted
+AUDIO_CACHE_PIN_SECONDS = 120
+
+class AudioCache:
+    # Opus files for tracks that are played often enough, kept under a byte
+    # budget. Play counts are tracked for every track so a file is only
+    # downloaded once a track has proved popular.
+    def __init__(self, cache_dir, max_bytes, min_plays=AUDIO_CACHE_MIN_PLAYS):
+        self.cache_dir = cache_dir
+        self.tmp_dir = os.path.join(cache_dir, 'tmp')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.entries = {}  # key -> {"plays", "last_played", "size"}; size > 0 once the file exists
+        self.total_bytes = 0
+        self.populating = {}
+        self.dirty = False
+        self.stats = {"hits": 0, "misses": 0, "downloads": 0, "download_errors": 0, "evictions": 0}
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.load()
+
+    def file_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.opus')
+
+    def load(self):
+        # Leftovers from downloads interrupted by a restart
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.entries = json.load(f)
+            except (json.JSONDecodeError, IOError) as e:
+                print(f"Error loading audio cache index: {e}. Starting empty.")
+        known = set()
+        for key, entry in self.entries.items():
+            path = self.file_path(key)
+            if entry["size"] and not os.path.exists(path):
+                entry["size"] = 0
+            self.total_bytes += entry["size"]
+            known.add(os.path.basename(path))
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.opus') and name not in known:
+                os.remove(os.path.join(self.cache_dir, name))
+        self.evict()
+
+    def snapshot(self):
+        # Taken on the event loop, which keeps updating entries while a
+        # worker thread writes the copy
+        self.dirty = False
+        return {key: dict(entry) for key, entry in self.entries.items()}
+
+    def save(self, entries=None):
+        if entries is None:
+            entries = self.snapshot()
+        try:
+            write_json_atomic(self.index_path, entries)
+        except IOError as e:
+            self.dirty = True
+            print(f"Error saving audio cache index: {e}")
+
+    def contains(self, key):
+        entry = self.entries.get(key)
+        return bool(entry and entry["size"])
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry and entry["size"]:
+            entry["plays"] += 1
+            entry["last_played"] = time.time()
+            self.dirty = True
+            self.stats["hits"] += 1
+            return self.file_path(key)
+        self.stats["misses"] += 1
+        return None
+
+    def record_play(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {"plays": 0, "last_played": 0, "size": 0}
+            if len(self.entries) > AUDIO_CACHE_TRACKED * 1.1:
+                self.prune_tracked()
+        entry["plays"] += 1
+        entry["last_played"] = time.time()
+        self.dirty = True
+        return entry["plays"] >= self.min_plays and key not in self.populating
+
+    def prune_tracked(self):
+        uncached = sorted((e["plays"], e["last_played"], k) for k, e in self.entries.items() if not e["size"])
+        for _, _, key in uncached[:len(self.entries) - AUDIO_CACHE_TRACKED]:
+            if key not in self.populating:
+                del self.entries[key]
+
+    def schedule_populate(self, key, stream_url, acodec):
+        if key in self.populating or self.contains(key):
+            return
+        self.populating[key] = asyncio.create_task(self.populate(key, stream_url, acodec))
+
+    async def populate(self, key, stream_url, acodec):
+        fd, tmp_path = tempfile.mkstemp(suffix='.opus', dir=self.tmp_dir)
+        os.close(fd)
+        if acodec == 'opus':
+            codec_args = ['-c:a', 'copy']
+        else:
+            codec_args = ['-c:a', 'libopus', '-b:a', '128k', '-ar', '48000', '-ac', '2']
+        try:
+            if shutil.disk_usage(self.cache_dir).free < self.max_bytes // 10:
+                return
+            proc = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-y', '-loglevel', 'error', *FFMPEG_BEFORE_OPTIONS.split(),
+                '-i', stream_url, '-vn', *codec_args, '-f', 'opus', tmp_path,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            try:
+                _, stderr = await asyncio.wait_for(proc.communicate(), AUDIO_CACHE_DOWNLOAD_TIMEOUT)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                stderr = b'timed out'
+            if proc.returncode != 0:
+                self.stats["download_errors"] += 1
+                print(f"Failed to cache audio for {key}: {stderr.decode(errors='replace').strip()}")
+                return
+            size = os.path.getsize(tmp_path)
+            # Readers only ever open complete files
+            os.replace(tmp_path, self.file_path(key))
+            entry = self.entries.setdefault(key, {"plays": 0, "last_played": time.time(), "size": 0})
+            self.total_bytes += size - entry["size"]
+            entry["size"] = size
+            self.dirty = True
+            self.stats["downloads"] += 1
+            self.evict()
+        except OSError as e:
+            self.stats["download_errors"] += 1
+            print(f"Failed to cache audio for {key}: {e}")
+        finally:
+            self.populating.pop(key, None)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        # Least played first, oldest first among equals
+        now = time.time()
+        candidates = sorted((e["plays"], e["last_played"], k) for k, e in self.entries.items()
+                            if e["size"] and now - e["last_played"] > AUDIO_CACHE_PIN_SECONDS)
+        for _, _, key in candidates:
+            if self.total_bytes <= self.max_bytes:
+                break
+            entry = self.entries[key]
+            try:
+                os.remove(self.file_path(key))
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= entry["size"]
+            entry["size"] = 0
+            self.stats["evictions"] += 1
+            self.dirty = True
+
+audio_cache = AudioCache(os.path.join(DATA_DIR, 'audio_cache' + PROCESS_SUFFIX), AUDIO_CACHE_MAX_MB * 1024 * 1024) if AUDIO_CACHE_MAX_MB > 0 else None
+
+# Normalization plays each track with a gain measured once in the background.
+# Until a track has been measured, only the NumPy stage can normalize it, adaptively.
+AUDIO_NORMALIZE = os.environ.get("AUDIO_NORMALIZE", "0") == "1"
+LOUDNESS_TARGET_LUFS = float(os.environ.get("LOUDNESS_TARGET_LUFS", "-16"))
+LOUDNESS_WORKERS = int(os.environ.get("LOUDNESS_WORKERS", "1"))
+LOUDNESS_CACHE_SIZE = int(os.environ.get("LOUDNESS_CACHE_SIZE", "50000"))
+LOUDNESS_MAX_GAIN_DB = 12.0
+# Smaller corrections aren't worth re-encoding an Opus stream for
+LOUDNESS_MIN_GAIN_DB = 0.5
+LOUDNESS_TIMEOUT = 300
+LOUDNESS_RE = re.compile(rb'I:\s+(-?[\d.]+) LUFS')
+# Analysis competes with live ffmpeg processes for CPU, so it runs niced
+LOUDNESS_NICE = ['nice', '-n', '10'] if shutil.which('nice') else []
+
+class LoudnessAnalyzer:
+    # Measures integrated loudness (EBU R128) once per track with ffmpeg and
+    # keeps the resulting gain per track. Playlist songs also get it stored on
+    # their record.
+    def __init__(self, path=None, workers=LOUDNESS_WORKERS, max_entries=LOUDNESS_CACHE_SIZE):
+        self.path = path or os.path.join(DATA_DIR, f'loudness{PROCESS_SUFFIX}.json')
+        self.workers = workers
+        self.max_entries = max_entries
+        self.gains = OrderedDict()  # track key -> gain in dB
+        self.waiting = {}  # track key -> (url, [(playlist_id, song_id), ...])
+        self.queue = None
+        self.dirty = False
+        self.stats = {"queued": 0, "analyzed": 0, "failed": 0}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self.gains = OrderedDict(json.load(f))
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error loading loudness cache: {e}. Starting empty.")
+
+    def save(self):
+        snapshot = list(self.gains.items())
+        self.dirty = False
+        try:
+            write_json_atomic(self.path, snapshot)
+        except IOError as e:
+            self.dirty = True
+            print(f"Error saving loudness cache: {e}")
+
+    def gain_for(self, song):
+        # None means play it as it is; unmeasured tracks are queued on first play
+        if not AUDIO_NORMALIZE:
+            return None
+        gain = song.get('gain_db')
+        if gain is None:
+            key = TrackResolver.cache_key(song['url'])
+            gain = self.gains.get(key)
+            if gain is None:
+                self.schedule(key, song['url'])
+        return gain
+
+    def schedule(self, key, url, record=None):
+        if key not in self.waiting:
+            self.waiting[key] = (url, [])
+            self.stats["queued"] += 1
+            if self.queue is None:
+                self.queue = asyncio.Queue()
+                for _ in range(self.workers):
+                    asyncio.create_task(self.worker())
+            self.queue.put_nowait(key)
+        if record is not None:
+            self.waiting[key][1].append(record)
+
+    def schedule_songs(self, songs):
+        # Returns how many songs are waiting on a new measurement
+        queued = 0
+        for song in songs:
+            key = TrackResolver.cache_key(song["url"])
+            if key in self.gains:
+                db.set_song_gain(song["playlist_id"], song["id"], self.gains[key])
+            else:
+                self.schedule(key, song["url"], (song["playlist_id"], song["id"]))
+                queued += 1
+        return queued
+
+    async def worker(self):
+        while True:
+            key = await self.queue.get()
+            url, records = self.waiting[key]
+            try:
+                gain = await self.analyze(key, url)
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Loudness analysis failed for {url}: {e}")
+                gain = None
+            del self.waiting[key]
+            if gain is None:
+                continue
+            self.stats["analyzed"] += 1
+            self.gains[key] = gain
+            self.gains.move_to_end(key)
+            while len(self.gains) > self.max_entries:
+                self.gains.popitem(last=False)
+            self.dirty = True
+            for playlist_id, song_id in records:
+                db.set_song_gain(playlist_id, song_id, gain)
+
+    async def analyze(self, key, url):
+        if audio_cache is not None and audio_cache.contains(key):
+            input_args = ['-i', audio_cache.file_path(key)]
+        else:
+            info = await resolver.resolve(url, priority=PRIORITY_BULK)
+            input_args = [*FFMPEG_BEFORE_OPTIONS.split(), '-i', info['url']]
+        proc = await asyncio.create_subprocess_exec(
+            *LOUDNESS_NICE, 'ffmpeg', '-hide_banner', '-nostats', '-threads', '1', *input_args,
+            '-vn', '-af', 'ebur128=framelog=quiet', '-f', 'null', '-',
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), LOUDNESS_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise
+        # The summary at the end repeats the integrated loudness; take the last one
+        measured = LOUDNESS_RE.findall(stderr)
+        if proc.returncode != 0 or not measured:
+            raise RuntimeError(stderr.decode(errors='replace').strip().splitlines()[-1] if stderr.strip() else f'ffmpeg exited with {proc.returncode}')
+        integrated = float(measured[-1])
+        if integrated <= -70:
+            # Silence; leave it alone rather than boosting the noise floor
+            return 0.0
+        return round(max(-LOUDNESS_MAX_GAIN_DB, min(LOUDNESS_MAX_GAIN_DB, LOUDNESS_TARGET_LUFS - integrated)), 2)
+
+loudness = LoudnessAnalyzer()
+if AUDIO_NORMALIZE:
+    db.on_songs_added = loudness.schedule_songs
+
+HISTORY_SIZE = int(os.environ.get("HISTORY_SIZE", "1000"))
+# A play that stopped sooner is a skip, unless it covered half the track
+HISTORY_PLAY_SECONDS = 30
+HISTORY_HALF_LIFE = 7 * 24 * 3600
+HISTORY_COMPACT_RATIO = 2
+# Off-peak pre-resolving of each guild's most played tracks; 0 turns it off
+HISTORY_WARM_INTERVAL = int(os.environ.get("HISTORY_WARM_INTERVAL", "600"))
+HISTORY_WARM_TRACKS = int(os.environ.get("HISTORY_WARM_TRACKS", "5"))
+HISTORY_WARM_LOOKAHEAD = 3600
+HISTORY_MAX_SECONDS = 65535  # listened and length are stored as unsigned 16-bit
+
+class PlayRing:
+    # One guild's most recent plays in parallel arrays (12 bytes a play). Once
+    # full, each new play overwrites the oldest.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tracks = array('I')  # index into PlayHistory.tracks
+        self.played_at = array('I')  # unix seconds when the track started
+        self.listened = array('H')
+        self.lengths = array('H')
+        self.next = 0
+        self.hours = array('I', [0] * 24)  # plays by UTC hour of day
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def append(self, track, played_at, listened, length):
+        self.hours[played_at // 3600 % 24] += 1
+        if len(self.tracks) < self.capacity:
+            self.tracks.append(track)
+            self.played_at.append(played_at)
+            self.listened.append(listened)
+            self.lengths.append(length)
+            return None
+        i = self.next
+        overwritten = self.played_at[i]
+        self.hours[overwritten // 3600 % 24] -= 1
+        self.tracks[i] = track
+        self.played_at[i] = played_at
+        self.listened[i] = listened
+        self.lengths[i] = length
+        self.next = (i + 1) % self.capacity
+        return overwritten
+
+    def newest_first(self):
+        n = len(self.tracks)
+        for j in range(n):
+            i = (self.next - 1 - j) % n
+            yield self.tracks[i], self.played_at[i], self.listened[i], self.lengths[i]
+
+def counts_as_play(listened, length):
+    return listened >= HISTORY_PLAY_SECONDS or (length and listened * 2 >= length)
+
+class PlayHistory:
+    # What each guild played and for how long. Plays are appended to a log in
+    # batches by the flush loop; the log is rewritten from the rings once it
+    # holds HISTORY_COMPACT_RATIO times more lines than they do.
+    def __init__(self, path=None, capacity=HISTORY_SIZE):
+        self.path = path or os.path.join(DATA_DIR, f'history{PROCESS_SUFFIX}.log')
+        self.capacity = capacity
+        self.rings = {}  # guild_id -> PlayRing
+        self.tracks = []  # (key, title), interned so each play stores an index
+        self.track_ids = {}  # key -> index in tracks
+        self.hours = [0] * 24  # plays by UTC hour of day, over every ring
+        self.pending = []
+        self.log_lines = 0
+        # Set when a compaction failed; the rows it dropped from pending are
+        # only in the rings, so the next batch compacts again
+        self.compact_due = False
+        self.stats = {"recorded": 0, "flushes": 0, "compactions": 0, "warmed": 0, "precached": 0}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    self.log_lines += 1
+                    try:
+                        self.add(*json.loads(line))
+                    except (json.JSONDecodeError, TypeError, ValueError):
+                        # A line cut short by a crash mid-write
+                        continue
+        except IOError as e:
+            print(f"Error loading play history: {e}. Starting empty.")
+        self.prune_tracks()
+
+    def prune_tracks(self):
+        # Rebuilds the intern table from the rings, dropping tracks whose
+        # plays have all been overwritten
+        tracks, track_ids, remap = [], {}, {}
+        for ring in self.rings.values():
+            for i, track in enumerate(ring.tracks):
+                new = remap.get(track)
+                if new is None:
+                    new = remap[track] = len(tracks)
+                    tracks.append(self.tracks[track])
+                    track_ids[self.tracks[track][0]] = new
+                ring.tracks[i] = new
+        self.tracks, self.track_ids = tracks, track_ids
+
+    def add(self, guild_id, key, title, played_at, listened, length):
+        track = self.track_ids.get(key)
+        if track is None:
+            track = self.track_ids[key] = len(self.tracks)
+            self.tracks.append((key, title))
+        ring = self.rings.get(guild_id)
+        if ring is None:
+            ring = self.rings[guild_id] = PlayRing(self.capacity)
+        self.hours[played_at // 3600 % 24] += 1
+        overwritten = ring.append(track, played_at, listened, length)
+        if overwritten is not None:
+            self.hours[overwritten // 3600 % 24] -= 1
+
+    def record(self, guild_id, song, listened):
+        # Nothing was heard, e.g. the stream failed to open
+        if listened < 1:
+            return
+        listened = min(int(listened), HISTORY_MAX_SECONDS)
+        row = [guild_id, TrackResolver.cache_key(song['url']), song['title'], int(time.time()) - listened,
+               listened, min(int(song.get('seconds') or 0), HISTORY_MAX_SECONDS)]
+        self.add(*row)
+        self.pending.append(row)
+        self.stats["recorded"] += 1
+
+    def take_batch(self):
+        # Runs on the event loop so the rings aren't read while a play is added;
+        # write() can then run in a worker
+        live = sum(len(ring) for ring in self.rings.values())
+        if self.compact_due or self.log_lines + len(self.pending) > HISTORY_COMPACT_RATIO * live + self.capacity:
+            self.prune_tracks()
+            rows = [[guild_id, *self.tracks[track], played_at, listened, length]
+                    for guild_id, ring in self.rings.items()
+                    for track, played_at, listened, length in reversed(list(ring.newest_first()))]
+            compact = True
+        else:
+            rows = self.pending
+            compact = False
+        self.pending = []
+        return rows, compact
+
+    def write(self, rows, compact):
+        # Only touches the file, so it can run in a worker; the result goes to
+        # finish_batch() back on the event loop
+        text = ''.join(json.dumps(row) + '\n' for row in rows)
+        try:
+            if compact:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.write(text)
+                os.replace(tmp_path, self.path)
+            else:
+                with open(self.path, 'a') as f:
+                    f.write(text)
+        except IOError as e:
+            print(f"Error saving play history: {e}")
+            return False
+        return True
+
+    def finish_batch(self, rows, compact, written):
+        if not written:
+            if compact:
+                self.compact_due = True
+            else:
+                self.pending[:0] = rows
+            return
+        if compact:
+            self.log_lines = len(rows)
+            self.compact_due = False
+            self.stats["compactions"] += 1
+        else:
+            self.log_lines += len(rows)
+        self.stats["flushes"] += 1
+
+    def recent(self, guild_id, limit):
+        ring = self.rings.get(guild_id)
+        if ring is None:
+            return []
+        return [{"key": self.tracks[track][0], "title": self.tracks[track][1], "played_at": played_at, "listened": listened, "length": length}
+                for track, played_at, listened, length in itertools.islice(ring.newest_first(), limit)]
+
+    def top(self, guild_id, since, limit):
+        ring = self.rings.get(guild_id)
+        if ring is None:
+            return []
+        plays = {}
+        for track, played_at, listened, length in ring.newest_first():
+            if played_at < since:
+                # Newest first, so everything after this is older still
+                break
+            if counts_as_play(listened, length):
+                count, total = plays.get(track, (0, 0))
+                plays[track] = (count + 1, total + listened)
+        ranked = sorted(plays.items(), key=lambda item: (-item[1][0], -item[1][1]))[:limit]
+        return [{"key": self.tracks[track][0], "title": self.tracks[track][1], "plays": count, "listened": total}
+                for track, (count, total) in ranked]
+
+    def popular(self, guild_id, limit, now=None):
+        # Keys ranked by how much of each play was listened to, with older
+        # plays counting for less
+        ring = self.rings.get(guild_id)
+        if ring is None:
+            return []
+        now = now or time.time()
+        scores = {}
+        for track, played_at, listened, length in ring.newest_first():
+            heard = min(1.0, listened / length) if length else 1.0
+            scores[track] = scores.get(track, 0.0) + heard * 0.5 ** ((now - played_at) / HISTORY_HALF_LIFE)
+        return [self.tracks[track][0] for track in sorted(scores, key=scores.get, reverse=True)[:limit]]
+
+    def is_off_peak(self, now=None):
+        # At or below the average hour for plays across every guild
+        total = sum(self.hours)
+        return total > 0 and self.hours[int(now or time.time()) // 3600 % 24] * 24 <= total
+
+    def likely_guilds(self, now=None):
+        # Guilds that have played at this time of day, or the next hour, before
+        hour = int(now or time.time()) // 3600 % 24
+        return [guild_id for guild_id, ring in self.rings.items()
+                if ring.hours[hour] or ring.hours[(hour + 1) % 24]]
+
+history = PlayHistory()
+
+IMPORT_CONCURRENCY = int(os.environ.get("IMPORT_CONCURRENCY", "4"))
+IMPORT_MAX_TRACKS = int(os.environ.get("IMPORT_MAX_TRACKS", "500"))
+IMPORT_PROGRESS_INTERVAL = 2.0
+
+FLAT_YTDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': 'in_playlist',
+}
+
+def extract_flat(url):
+    if process_pool is not None:
+        return process_pool.extract(FLAT_YTDL_OPTS, url)
+    with load_yt_dlp().YoutubeDL(FLAT_YTDL_OPTS) as ydl:
+        return ydl.extract_info(url, download=False)
+
+def is_playlist_url(url):
+    parsed = urlparse(url)
+    return 'list' in parse_qs(parsed.query) or parsed.path.rstrip('/').endswith('/playlist')
+
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", str(6 * 3600)))
+SEARCH_CACHE_SIZE = 2000
+search_cache = OrderedDict()  # search_key(query) -> (expires_at, url)
+search_stats = {"hits": 0, "misses": 0}
+
+def is_url(text):
+    return urlparse(text.strip()).scheme in ('http', 'https')
+
+async def search_youtube(query, guild_id):
+    # /play with words instead of a link plays the first YouTube result
+    key = search_key(query)
+    cached = search_cache.get(key)
+    if cached and cached[0] > time.time():
+        search_cache.move_to_end(key)
+        search_stats["hits"] += 1
+        return cached[1]
+    search_stats["misses"] += 1
+    info = await extractor.run(extract_flat, f'ytsearch1:{query}', priority=PRIORITY_PLAY, guild_id=guild_id)
+    entries = [entry for entry in info.get('entries') or [] if entry]
+    if not entries:
+        raise ValueError(f'No results for "{query}"')
+    url = entries[0].get('url') or entries[0].get('webpage_url') or entries[0]['id']
+    search_cache[key] = (time.time() + SEARCH_CACHE_TTL, url)
+    search_cache.move_to_end(key)
+    while len(search_cache) > SEARCH_CACHE_SIZE:
+        search_cache.popitem(last=False)
+    return url
+
+def format_duration(seconds):
+    # Matches yt_dlp's duration_string
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes}:{seconds:02d}'
+
+async def enumerate_import(source, guild_id):
+    # source is a playlist URL or several video/playlist URLs separated by spaces or commas
+    tracks = []
+    for url in source.replace(',', ' ').split():
+        if not is_playlist_url(url):
+            tracks.append({'url': url, 'title': None, 'duration': None})
+            continue
+        info = await extractor.run(extract_flat, url, priority=PRIORITY_BULK, guild_id=guild_id)
+        for entry in info.get('entries') or []:
+            if entry:
+                tracks.append({
+                    'url': entry.get('url') or entry.get('webpage_url') or entry['id'],
+                    'title': entry.get('title'),
+                    'duration': entry.get('duration'),
+                })
+    # The total is returned too, so the caller can say when the cap cut it short
+    return tracks[:IMPORT_MAX_TRACKS], len(tracks)
+
+async def import_into_playlist(interaction, playlist_obj, source, label):
+    message = await interaction.followup.send('⏳ Reading tracks...', wait=True)
+    try:
+        tracks, total = await enumerate_import(source, interaction.guild.id)
+    except Exception as e:
+        await message.edit(content=f'❌ Failed to read tracks: {str(e)}')
+        return
+    if not tracks:
+        await message.edit(content='❌ Nothing to import!')
+        return
+    semaphore = asyncio.Semaphore(IMPORT_CONCURRENCY)
+    progress = {'done': 0, 'edited_at': 0.0}
+
+    async def report():
+        now = time.monotonic()
+        if now - progress['edited_at'] >= IMPORT_PROGRESS_INTERVAL:
+            progress['edited_at'] = now
+            await message.edit(content=f'⏳ Importing into {label} **{playlist_obj["name"]}**: {progress["done"]}/{len(tracks)}')
+
+    async def fill(track):
+        # Flat playlist entries usually carry title and duration already
+        if track['title'] is None or track['duration'] is None:
+            async with semaphore:
+                try:
+                    info = await resolver.resolve(track['url'], need_stream=False,
+                                                  priority=PRIORITY_BULK, guild_id=interaction.guild.id)
+                    track['title'] = info['title']
+                    track['duration'] = info['duration']
+                except Exception as e:
+                    track['error'] = str(e)
+        progress['done'] += 1
+        await report()
+
+    await asyncio.gather(*(fill(track) for track in tracks))
+    rows = []
+    failed = too_long = 0
+    for track in tracks:
+        if 'error' in track or track['duration'] is None:
+            failed += 1
+        elif track['duration'] > 600:
+            too_long += 1
+        else:
+            rows.append((track['url'], track['title'], format_duration(track['duration'])))
+    result = db.add_songs(playlist_obj["id"], rows) if rows else {'success': True, 'added': 0}
+    if not result['success']:
+        await message.edit(content=f'❌ Failed to add songs: {result["error"]}')
+        return
+    skipped = ''
+    if too_long:
+        skipped += f', {too_long} too long'
+    if failed:
+        skipped += f', {failed} unavailable'
+    if total > len(tracks):
+        count = f'{result["added"]} of {total} songs (limit {IMPORT_MAX_TRACKS})'
+    else:
+        count = f'{result["added"]} songs'
+    await message.edit(content=f'✅ Imported {count} into {label} **{playlist_obj["name"]}**{skipped}')
+
+async def resolve_for_playback(url, guild_id, priority=PRIORITY_PLAY):
+    # A locally cached file only needs metadata, not a fresh stream URL
+    cached = audio_cache is not None and audio_cache.contains(TrackResolver.cache_key(url))
+    return await resolver.resolve(url, need_stream=not cached, priority=priority, guild_id=guild_id)
+
+def background_resolve(url, guild_id, priority):
+    # Outlives a cancelled caller; the failure is dropped if nobody is left to see it
+    task = asyncio.create_task(resolve_for_playback(url, guild_id, priority))
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return task
+
+@tasks.loop(seconds=60)
+async def flush_resolver_cache():
+    if resolver_cache.dirty:
+        await asyncio.to_thread(resolver_cache.save)
+    if audio_cache is not None:
+        # Catch up on files that were pinned when the budget was exceeded
+        audio_cache.evict()
+        if audio_cache.dirty:
+            await asyncio.to_thread(audio_cache.save, audio_cache.snapshot())
+    if loudness.dirty:
+        await asyncio.to_thread(loudness.save)
+    if history.pending:
+        rows, compact = history.take_batch()
+        history.finish_batch(rows, compact, await asyncio.to_thread(history.write, rows, compact))
+
+async def warm_track(guild_id, key):
+    if audio_cache is not None and audio_cache.contains(key):
+        return
+    entry = resolver_cache.entries.get(key)
+    # Still playable by the time the guild is expected back
+    if not (entry and entry.get("stream_url") and entry["expires_at"] - time.time() > HISTORY_WARM_LOOKAHEAD + STREAM_EXPIRY_MARGIN):
+        entry = await resolver.extract(key, key, PRIORITY_BULK, guild_id)
+        history.stats["warmed"] += 1
+    # Popular enough to download, while there's room that won't evict anything
+    cached = audio_cache.entries.get(key) if audio_cache is not None else None
+    if (cached and cached["plays"] >= audio_cache.min_plays and entry.get("stream_url")
+            and audio_cache.total_bytes < audio_cache.max_bytes * 0.9):
+        audio_cache.schedule_populate(key, entry["stream_url"], entry.get("acodec"))
+        history.stats["precached"] += 1
+
+@tasks.loop(seconds=HISTORY_WARM_INTERVAL or 600)
+async def warm_popular_tracks():
+    # Re-resolves the most played tracks of guilds that usually play around
+    # this time, while the extractor has nothing else to do
+    if not history.is_off_peak():
+        return
+    for guild_id in history.likely_guilds():
+        if guild_id in players or not owns_guild(guild_id):
+            continue
+        for key in history.popular(guild_id, HISTORY_WARM_TRACKS):
+            if extractor.waiting_count or not history.is_off_peak():
+                return
+            try:
+                await warm_track(guild_id, key)
+            except Exception as e:
+                print(f"Warming {key} for guild {guild_id} failed: {e}")
+
+def ffmpeg_children():
+    # pid -> argv of every ffmpeg this process has spawned; empty without /proc
+    pid = str(os.getpid())
+    children = {}
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return children
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+            # "pid (comm) state ppid ..."
+            comm = stat[stat.find('(') + 1:stat.rfind(')')]
+            if comm != 'ffmpeg' or stat[stat.rfind(')') + 2:].split()[1] != pid:
+                continue
+            with open(f'/proc/{entry}/cmdline', 'rb') as f:
+                children[int(entry)] = f.read().decode(errors='replace').split('\0')
+        except OSError:
+            continue
+    return children
+
+def count_ffmpeg_processes():
+    return len(ffmpeg_children())
+
+def register_metrics():
+    metrics.gauge('musicbot_voice_connections', 'Connected voice clients', lambda: len(bot.voice_clients))
+    metrics.gauge('musicbot_players', 'Guilds with a player', lambda: len(players))
+    metrics.gauge('musicbot_startup_seconds', 'Seconds from process start to each startup phase, or its duration for background steps',
+                  lambda: {(phase,): value for phase, value in startup_times.items() if isinstance(value, float)}, ('phase',))
+    metrics.gauge('musicbot_ffmpeg_processes', 'Live ffmpeg child processes', count_ffmpeg_processes)
+    metrics.gauge('musicbot_playlist_storage_bytes', 'Size of the playlist storage files', lambda: db.storage.size_bytes())
+    metrics.gauge('musicbot_playback_sources', 'Audio sources created, by path', lambda: {
+        (path,): retired_playback_paths[path] + sum(counts[path] for counts in playback_paths.values())
+        for path in ('opus', 'pcm', 'cache')
+    }, ('path',))
+    metrics.stats_dict('musicbot_playlist_db', 'PlaylistDB write-behind stats', lambda: db.stats)
+    metrics.stats_dict('musicbot_reaper', 'Idle voice session reaper stats', lambda: reaper_stats)
+    metrics.stats_dict('musicbot_search_cache', '/play search cache stats', lambda: search_stats)
+    metrics.stats_dict('musicbot_history', 'Play history and warmer stats', lambda: history.stats)
+    if AUDIO_NORMALIZE:
+        metrics.stats_dict('musicbot_loudness', 'Loudness analysis stats', lambda: loudness.stats)
+        metrics.gauge('musicbot_loudness_waiting', 'Tracks waiting for loudness analysis', lambda: len(loudness.waiting))
+    metrics.stats_dict('musicbot_resolver', 'Track resolver stats', lambda: {
+        'cache_hits': resolver_cache.hits,
+        'cache_misses': resolver_cache.misses,
+        'cache_entries': len(resolver_cache.entries),
+        'coalesced': resolver.coalesced,
+        'negative_hits': resolver.negative_hits,
+        'inflight': len(resolver.inflight),
+    })
+    metrics.stats_dict('musicbot_extractor', 'Extraction scheduler stats by priority class',
+                       lambda: {(name,): stats for name, stats in extractor.stats.items()}, ('priority',))
+    metrics.gauge('musicbot_extractor_waiting', 'Extraction jobs waiting for a worker', lambda: extractor.waiting_count)
+    metrics.gauge('musicbot_extractor_running', 'Extraction jobs running', lambda: extractor.running)
+    if process_pool is not None:
+        metrics.stats_dict('musicbot_extract_process', 'Extraction worker process stats', lambda: process_pool.stats)
+    if audio_cache is not None:
+        metrics.stats_dict('musicbot_audio_cache', 'Audio cache stats', lambda: audio_cache.stats)
+        metrics.gauge('musicbot_audio_cache_bytes', 'Bytes of Opus files in the audio cache', lambda: audio_cache.total_bytes)
+
+async def serve_metrics(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        if request.split()[1:2] == [b'/metrics']:
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def monitor_loop_lag():
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_seconds.observe(max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL))
+
+async def start_metrics():
+    register_metrics()
+    # Processes running other shards get their own port
+    port = METRICS_PORT + (SHARD_IDS[0] if MULTI_PROCESS else 0)
+    await asyncio.start_server(serve_metrics, METRICS_HOST, port)
+    asyncio.create_task(monitor_loop_lag())
+    print(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    command_seconds.observe(time.time() - interaction.created_at.timestamp(), command.qualified_name, 'ok')
+
+@bot.tree.error
+async def on_app_command_error(interaction, error):
+    if interaction.command is not None:
+        command_seconds.observe(time.time() - interaction.created_at.timestamp(), interaction.command.qualified_name, 'error')
+    # Keep the default traceback logging
+    await app_commands.CommandTree.on_error(bot.tree, interaction, error)
+
+COMMAND_TREE_HASH_PATH = os.path.join(DATA_DIR, 'command_tree.json')
+
+def command_tree_hash():
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+async def sync_commands():
+    # Syncing is rate limited and only needed when a command definition changed
+    started = time.perf_counter()
+    state = {"application_id": bot.application_id, "hash": command_tree_hash()}
+    try:
+        with open(COMMAND_TREE_HASH_PATH, 'r') as f:
+            synced = json.load(f)
+    except (json.JSONDecodeError, IOError):
+        synced = None
+    if synced == state and os.environ.get("FORCE_COMMAND_SYNC") != "1":
+        startup_times["command sync"] = 'skipped'
+        return
+    await bot.tree.sync()
+    write_json_atomic(COMMAND_TREE_HASH_PATH, state)
+    mark_startup('command sync', started)
+
+async def warm_up():
+    started = time.perf_counter()
+    await db.ensure_loaded()
+    startup_times["playlist load"] = db.load_seconds
+    if process_pool is None:
+        await asyncio.to_thread(load_yt_dlp)
+    # Commands are global, so one process syncing them is enough
+    if not MULTI_PROCESS or 0 in SHARD_IDS:
+        try:
+            await sync_commands()
+        except discord.HTTPException as e:
+            print(f"Error syncing commands: {e}")
+    mark_startup('warm-up', started)
+    report_startup()
+
+def report_startup():
+    # Printed once both the gateway and the background warm-up are done
+    if "ready" not in startup_times or "warm-up" not in startup_times or startup_times.get("reported"):
+        return
+    startup_times["reported"] = True
+    print('Startup: ' + ', '.join(f'{phase} {value:.2f}s' if isinstance(value, float) else f'{phase} {value}'
+                                  for phase, value in startup_times.items() if phase != 'reported'))
+
+@bot.event
+async def setup_hook():
+    mark_startup('login')
+    db.start_write_behind()
+    # Loading playlists, importing yt_dlp and syncing commands all happen
+    # while the gateway connects instead of before it
+    asyncio.create_task(warm_up())
+    if METRICS_PORT:
+        await start_metrics()
+    try:
+        # Docker stops containers with SIGTERM; close cleanly so pending writes land
+        bot.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+    except NotImplementedError:
+        pass
 
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user}')
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name='music :3'))
-    await bot.tree.sync()  # Sync slash commands
+    if not flush_resolver_cache.is_running():
+        flush_resolver_cache.start()
+    if not reap_idle_players.is_running():
+        reap_idle_players.start()
+    if HISTORY_WARM_INTERVAL and not warm_popular_tracks.is_running():
+        warm_popular_tracks.start()
+    # on_ready fires again after every reconnect
+    if "ready" not in startup_times:
+        mark_startup('ready')
+        report_startup()
 
 @bot.tree.command(name='join', description='Join your voice channel')
 async def join(interaction: discord.Interaction):
     if not interaction.user.voice:
         await interaction.response.send_message('You need to be in a voice channel!')
         return
-    vc = await interaction.user.voice.channel.connect()
-    connections[interaction.guild.id] = vc
+    try:
+        await connect_player(interaction.guild.id, interaction.user.voice.channel)
+    except VoiceSessionLimit as e:
+        await interaction.response.send_message(f'❌ {e}')
+        return
     await interaction.response.send_message(f'Joined {interaction.user.voice.channel.name}!')
 
 @bot.tree.command(name='leave', description='Leave the voice channel')
 async def leave(interaction: discord.Interaction):
-    vc = connections.get(interaction.guild.id)
-    if not vc:
+    player = players.get(interaction.guild.id)
+    if not player:
         await interaction.response.send_message('I am not connected to any voice channel!')
         return
-    # player = players.get(interaction.guild.id)  # Removed
-    # if player:  # Removed
-    #     player.stop()  # Removed
-    #     players.pop(interaction.guild.id, None)  # Removed
-    if vc.is_playing() or vc.is_paused():
-        vc.stop()
-    queues.pop(interaction.guild.id, None)
-    await vc.disconnect()
-    connections.pop(interaction.guild.id, None)
+    await player.disconnect()
     await interaction.response.send_message('👋 Left the voice channel!')
 
-@bot.tree.command(name='play', description='Play a YouTube video')
-async def play(interaction: discord.Interaction, url: str):
+@bot.tree.command(name='play', description='Play a YouTube link or search, or queue it if something is playing')
+async def play(interaction: discord.Interaction, query: str):
     await interaction.response.defer()
-    vc = connections.get(interaction.guild.id)
-    if not vc:
-        if not interaction.user.voice:
-            await interaction.followup.send('You need to be in a voice channel!')
-            return
-        vc = await interaction.user.voice.channel.connect()
-        connections[interaction.guild.id] = vc
-    if vc.is_playing() or vc.is_paused():
-        vc.stop()
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'no_warnings': True,
-        'noplaylist': True,
-        'ffmpeg_location': 'ffmpeg',
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            info = await asyncio.to_thread(ydl.extract_info, url, download=False)
-            if info['duration'] > 600:
-                await interaction.followup.send('Song is too long!')
-                return
-            audio_url = info['url']
-        except Exception as e:
-            await interaction.followup.send(f'Error processing video: {str(e)}')
+    try:
+        player = await ensure_player(interaction)
+    except VoiceSessionLimit as e:
+        await interaction.followup.send(f'❌ {e}')
+        return
+    if not player:
+        await interaction.followup.send('You need to be in a voice channel!')
+        return
+    try:
+        url = query if is_url(query) else await search_youtube(query, interaction.guild.id)
+        info = await resolve_for_playback(url, interaction.guild.id)
+        if info['duration'] > 600:
+            await interaction.followup.send('Song is too long!')
             return
-    # Stream directly instead of downloading
-    source = discord.FFmpegPCMAudio(
-        audio_url,
-        before_options='-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-        options='-vn'
-    )
-    vc.play(source)
+    except Exception as e:
+        await interaction.followup.send(f'Error processing video: {str(e)}')
+        return
+    song = {'title': info['title'], 'url': url, 'duration': info.get('duration_string', ''), 'seconds': info['duration']}
+    if player.now_playing is None and not player.is_active():
+        song['requested_at'] = interaction.created_at.timestamp()
+    player.enqueue([song])
+    if player.now_playing is not None or player.is_active():
+        await interaction.followup.send(f'🎵 Queued **{info["title"]}** at position {len(player.queue)}')
+        return
+    await player.play_next()
     await interaction.followup.send(f'Now playing: {info["title"]}')
 
 @bot.tree.command(name='pause', description='Pause the current audio')
 async def pause(interaction: discord.Interaction):
-    vc = connections.get(interaction.guild.id)
-    if not vc or not vc.is_playing():
+    player = players.get(interaction.guild.id)
+    if not player or not player.vc.is_playing():
         await interaction.response.send_message('No audio is currently playing!')
         return
-    vc.pause()
+    player.vc.pause()
     await interaction.response.send_message('⏸️ Audio paused!')
 
 @bot.tree.command(name='resume', description='Resume the paused audio')
 async def resume(interaction: discord.Interaction):
-    vc = connections.get(interaction.guild.id)
-    if not vc or not vc.is_paused():
+    player = players.get(interaction.guild.id)
+    if not player or not player.vc.is_paused():
         await interaction.response.send_message('No audio is currently paused!')
         return
-    vc.resume()
+    player.vc.resume()
     await interaction.response.send_message('▶️ Audio resumed!')
 
+@bot.tree.command(name='volume', description='Set the playback volume in percent (0-200)')
+async def volume(interaction: discord.Interaction, percent: int):
+    player = players.get(interaction.guild.id)
+    if not player:
+        await interaction.response.send_message('I am not connected to any voice channel!')
+        return
+    if numpy is None:
+        await interaction.response.send_message('❌ Volume control needs NumPy installed')
+        return
+    if percent < 0 or percent > 200:
+        await interaction.response.send_message('❌ Invalid volume! Choose between 0 and 200.')
+        return
+    player.volume = percent / 100
+    # Warm sources were built for the old mode
+    player.reset_prefetch()
+    if isinstance(player.vc.source, DSPSource) or not player.is_active():
+        await interaction.response.send_message(f'🔊 Volume set to {percent}%')
+    else:
+        await interaction.response.send_message(f'🔊 Volume set to {percent}%, starting with the next song')
+
+@bot.tree.command(name='loudness-backfill', description="Measure the loudness of this server's playlist songs (Music Guy only)")
+async def loudness_backfill(interaction: discord.Interaction):
+    if not has_music_guy_role(interaction.user):
+        await interaction.response.send_message('❌ Only users with the "Music Guy" role can start a loudness backfill!')
+        return
+    if not AUDIO_NORMALIZE:
+        await interaction.response.send_message('❌ Loudness normalization is turned off (AUDIO_NORMALIZE)')
+        return
+    songs = [s for p in db.get_playlists_in_guild(str(interaction.guild.id)) for s in db.get_songs(p["id"]) if s.get("gain_db") is None]
+    queued = loudness.schedule_songs(songs)
+    await interaction.response.send_message(f'🔊 Measuring {queued} songs in the background ({len(songs) - queued} were already measured elsewhere)')
+
 @bot.tree.command(name='stop', description='Stop the current audio and disconnect')
 async def stop(interaction: discord.Interaction):
-    vc = connections.get(interaction.guild.id)
-    # player = players.get(interaction.guild.id)  # Removed
-    # if player:  # Removed
-    #     player.stop()  # Removed
-    #     players.pop(interaction.guild.id, None)  # Removed
-    if vc and (vc.is_playing() or vc.is_paused()):
-        vc.stop()
-    queues.pop(interaction.guild.id, None)
-    if vc:
-        await vc.disconnect()
-        connections.pop(interaction.guild.id, None)
+    player = players.get(interaction.guild.id)
+    if player:
+        await player.disconnect()
     await interaction.response.send_message('⏹️ Stopped audio and disconnected from voice channel!')
 
+@bot.tree.command(name='skip', description='Skip the current song')
+async def skip(interaction: discord.Interaction):
+    player = players.get(interaction.guild.id)
+    if not player or not player.is_active():
+        await interaction.response.send_message('No audio is currently playing!')
+        return
+    title = player.now_playing["title"] if player.now_playing else 'current song'
+    player.skip()
+    await interaction.response.send_message(f'⏭️ Skipped **{title}**')
+
 @bot.tree.command(name='queue', description='Show the current queue')
 async def queue_cmd(interaction: discord.Interaction):
-    queue = queues.get(interaction.guild.id)
-    if not queue or len(queue) == 0:
+    player = players.get(interaction.guild.id)
+    if not player or len(player.queue) == 0:
         await interaction.response.send_message('No songs in queue!')
         return
-    queue_list = '\n'.join([f'{i+1}. **{song["title"]}** ({song.get("duration", "")})' for i, song in enumerate(queue[:10])])
+    queue = player.queue
+    now = f'▶️ Now playing: **{player.now_playing["title"]}**\n' if player.now_playing else ''
+    queue_list = '\n'.join([f'{i+1}. **{song["title"]}** ({song.get("duration", "")})' for i, song in enumerate(itertools.islice(queue, 10))])
     more = f'\n... and {len(queue) - 10} more songs' if len(queue) > 10 else ''
-    await interaction.response.send_message(f'🎵 **Current Queue** ({len(queue)} songs):\n{queue_list}{more}')
+    await interaction.response.send_message(f'{now}🎵 **Current Queue** ({len(queue)} songs):\n{queue_list}{more}')
+
+@bot.tree.command(name='queue-remove', description='Remove a song from the queue')
+async def queue_remove(interaction: discord.Interaction, position: int):
+    player = players.get(interaction.guild.id)
+    if not player or len(player.queue) == 0:
+        await interaction.response.send_message('No songs in queue!')
+        return
+    if position < 1 or position > len(player.queue):
+        await interaction.response.send_message(f'❌ Invalid position! Choose between 1 and {len(player.queue)}.')
+        return
+    song = player.remove_at(position - 1)
+    await interaction.response.send_message(f'✅ Removed **{song["title"]}** from the queue')
+
+@bot.tree.command(name='queue-move', description='Move a song to a different position in the queue')
+async def queue_move(interaction: discord.Interaction, from_pos: int, to_pos: int):
+    player = players.get(interaction.guild.id)
+    if not player or len(player.queue) == 0:
+        await interaction.response.send_message('No songs in queue!')
+        return
+    if from_pos < 1 or from_pos > len(player.queue) or to_pos < 1 or to_pos > len(player.queue):
+        await interaction.response.send_message(f'❌ Invalid position! Choose between 1 and {len(player.queue)}.')
+        return
+    if from_pos == to_pos:
+        await interaction.response.send_message('❌ Song is already at that position!')
+        return
+    player.move(from_pos - 1, to_pos - 1)
+    await interaction.response.send_message(f'✅ Moved song from position {from_pos} to {to_pos} in the queue')
+
+@bot.tree.command(name='queue-shuffle', description='Shuffle the queue without changing any playlist')
+async def queue_shuffle(interaction: discord.Interaction):
+    player = players.get(interaction.guild.id)
+    if not player or len(player.queue) < 2:
+        await interaction.response.send_message('❌ Queue needs at least 2 songs to shuffle!')
+        return
+    player.shuffle()
+    await interaction.response.send_message(f'🔀 Shuffled the queue ({len(player.queue)} songs)')
+
+@bot.tree.command(name='history', description='Show the songs played recently in this server')
+async def history_cmd(interaction: discord.Interaction, count: int = 10):
+    if count < 1 or count > 25:
+        await interaction.response.send_message('❌ Invalid count! Choose between 1 and 25.')
+        return
+    plays = history.recent(interaction.guild.id, count)
+    if not plays:
+        await interaction.response.send_message('Nothing has been played here yet!')
+        return
+    lines = []
+    for i, p in enumerate(plays):
+        heard = format_duration(p["listened"]) + (f' of {format_duration(p["length"])}' if p["length"] else '')
+        lines.append(f'{i+1}. **{p["title"]}** ({heard}) <t:{p["played_at"]}:R>')
+    await interaction.response.send_message('🕘 **Recently Played**:\n' + '\n'.join(lines))
+
+@bot.tree.command(name='top', description='Show the most played songs in this server')
+async def top(interaction: discord.Interaction, days: int = 30):
+    if days < 1:
+        await interaction.response.send_message('❌ Invalid number of days!')
+        return
+    tracks = history.top(interaction.guild.id, time.time() - days * 86400, 10)
+    if not tracks:
+        await interaction.response.send_message(f'Nothing has been played here in the last {days} days!')
+        return
+    lines = [f'{i+1}. **{t["title"]}** ({t["plays"]} plays, {format_duration(t["listened"])} listened)' for i, t in enumerate(tracks)]
+    await interaction.response.send_message(f'🏆 **Most Played** (last {days} days):\n' + '\n'.join(lines))
 
 @bot.tree.command(name='playlist-create', description='Create a new playlist')
 async def playlist_create(interaction: discord.Interaction, name: str):
@@ -315,16 +2659,28 @@ async def playlist_add(interaction: discord.Interaction, playlist: str, url: str
     if not playlist_obj:
         await interaction.followup.send(f'❌ Playlist "{playlist}" not found!')
         return
-    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'noplaylist': True}) as ydl:
-        info = await asyncio.to_thread(ydl.extract_info, url, download=False)
+    try:
+        info = await resolver.resolve(url, need_stream=False, guild_id=interaction.guild.id)
         if info['duration'] > 600:
             await interaction.followup.send('Song is too long!')
             return
-        result = db.add_song(playlist_obj["id"], url, info['title'], str(info.get('duration_string', '')))
-        if result['success']:
-            await interaction.followup.send(f'✅ Added **{info["title"]}** to playlist **{playlist}**')
-        else:
-            await interaction.followup.send(f'❌ Failed to add song: {result["error"]}')
+    except Exception as e:
+        await interaction.followup.send(f'Error processing video: {str(e)}')
+        return
+    result = db.add_song(playlist_obj["id"], url, info['title'], str(info.get('duration_string', '')))
+    if result['success']:
+        await interaction.followup.send(f'✅ Added **{info["title"]}** to playlist **{playlist}**')
+    else:
+        await interaction.followup.send(f'❌ Failed to add song: {result["error"]}')
+
+@bot.tree.command(name='playlist-import', description='Import a YouTube playlist or several URLs into your playlist')
+async def playlist_import(interaction: discord.Interaction, playlist: str, source: str):
+    await interaction.response.defer(ephemeral=True)
+    playlist_obj = db.get_playlist_by_name(playlist, str(interaction.user.id), str(interaction.guild.id))
+    if not playlist_obj:
+        await interaction.followup.send(f'❌ Playlist "{playlist}" not found!')
+        return
+    await import_into_playlist(interaction, playlist_obj, source, 'playlist')
 
 @bot.tree.command(name='playlist-play', description='Play a playlist')
 async def playlist_play(interaction: discord.Interaction, name: str, shuffle: bool = False):
@@ -335,23 +2691,27 @@ async def playlist_play(interaction: discord.Interaction, name: str, shuffle: bo
     if not playlist:
         await interaction.followup.send(f'❌ Playlist "{name}" not found!')
         return
-    if shuffle:
-        db.shuffle_playlist(playlist["id"])
     songs = db.get_songs(playlist["id"])
     if len(songs) == 0:
         await interaction.followup.send(f'❌ Playlist "{name}" is empty!')
         return
-    vc = connections.get(interaction.guild.id)
-    if not vc:
-        if not interaction.user.voice:
-            await interaction.followup.send('You need to be in a voice channel!')
-            return
-        vc = await interaction.user.voice.channel.connect()
-        connections[interaction.guild.id] = vc
-    if vc.is_playing() or vc.is_paused():
-        vc.stop()
-    queues[interaction.guild.id] = [{'title': s["title"], 'url': s["url"], 'duration': s["duration"]} for s in songs]
-    await play_next_song(interaction.guild.id, vc)
+    try:
+        player = await ensure_player(interaction)
+    except VoiceSessionLimit as e:
+        await interaction.followup.send(f'❌ {e}')
+        return
+    if not player:
+        await interaction.followup.send('You need to be in a voice channel!')
+        return
+    player.replace_queue([{'title': s["title"], 'url': s["url"], 'duration': s["duration"], 'gain_db': s.get("gain_db")} for s in songs])
+    if shuffle:
+        player.shuffle()
+    player.queue[0]['requested_at'] = interaction.created_at.timestamp()
+    if player.is_active():
+        # The after-callback starts the new queue
+        player.vc.stop()
+    else:
+        await player.play_next()
     await interaction.followup.send(f'🎵 Playing playlist **{name}** ({len(songs)} songs)')
 
 @bot.tree.command(name='playlist-list', description='List your playlists')
@@ -371,13 +2731,13 @@ async def playlist_show(interaction: discord.Interaction, name: str):
     if not playlist:
         await interaction.response.send_message(f'❌ Playlist "{name}" not found!', ephemeral=True)
         return
-    songs = db.get_songs(playlist["id"])
-    if len(songs) == 0:
+    count = db.count_songs(playlist["id"])
+    if count == 0:
         await interaction.response.send_message(f'📋 Playlist **{name}** is empty!', ephemeral=True)
         return
-    song_list = '\n'.join([f'{i+1}. **{s["title"]}** ({s["duration"] or ""})' for i, s in enumerate(songs[:10])])
-    more = f'\n... and {len(songs) - 10} more songs' if len(songs) > 10 else ''
-    await interaction.response.send_message(f'📋 Playlist **{name}** ({len(songs)} songs):\n{song_list}{more}', ephemeral=True)
+    song_list = '\n'.join([f'{i+1}. **{s["title"]}** ({s["duration"] or ""})' for i, s in enumerate(db.get_songs(playlist["id"], limit=10))])
+    more = f'\n... and {count - 10} more songs' if count > 10 else ''
+    await interaction.response.send_message(f'📋 Playlist **{name}** ({count} songs):\n{song_list}{more}', ephemeral=True)
 
 @bot.tree.command(name='playlist-delete', description='Delete a playlist')
 async def playlist_delete(interaction: discord.Interaction, name: str):
@@ -412,16 +2772,31 @@ async def public_playlist_add(interaction: discord.Interaction, playlist: str, u
     if not playlist_obj:
         await interaction.followup.send(f'❌ Public playlist "{playlist}" not found!')
         return
-    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'noplaylist': True}) as ydl:
-        info = await asyncio.to_thread(ydl.extract_info, url, download=False)
+    try:
+        info = await resolver.resolve(url, need_stream=False, guild_id=interaction.guild.id)
         if info['duration'] > 600:
             await interaction.followup.send('Song is too long!')
             return
-        result = db.add_song(playlist_obj["id"], url, info['title'], str(info.get('duration_string', '')))
-        if result['success']:
-            await interaction.followup.send(f'✅ Added **{info["title"]}** to public playlist **{playlist}**')
-        else:
-            await interaction.followup.send(f'❌ Failed to add song: {result["error"]}')
+    except Exception as e:
+        await interaction.followup.send(f'Error processing video: {str(e)}')
+        return
+    result = db.add_song(playlist_obj["id"], url, info['title'], str(info.get('duration_string', '')))
+    if result['success']:
+        await interaction.followup.send(f'✅ Added **{info["title"]}** to public playlist **{playlist}**')
+    else:
+        await interaction.followup.send(f'❌ Failed to add song: {result["error"]}')
+
+@bot.tree.command(name='public-playlist-import', description='Import a YouTube playlist or several URLs into a public playlist (Music Guy only)')
+async def public_playlist_import(interaction: discord.Interaction, playlist: str, source: str):
+    if not has_music_guy_role(interaction.user):
+        await interaction.response.send_message('❌ Only users with the "Music Guy" role can edit public playlists!')
+        return
+    await interaction.response.defer()
+    playlist_obj = db.get_public_playlist_by_name(playlist, str(interaction.guild.id))
+    if not playlist_obj:
+        await interaction.followup.send(f'❌ Public playlist "{playlist}" not found!')
+        return
+    await import_into_playlist(interaction, playlist_obj, source, 'public playlist')
 
 @bot.tree.command(name='public-playlist-delete', description='Delete a public playlist (Music Guy only)')
 async def public_playlist_delete(interaction: discord.Interaction, name: str):
@@ -457,11 +2832,10 @@ async def playlist_remove(interaction: discord.Interaction, playlist: str, posit
     if not playlist_obj:
         await interaction.response.send_message(f'❌ Playlist "{playlist}" not found!', ephemeral=True)
         return
-    songs = db.get_songs(playlist_obj["id"])
-    if position < 1 or position > len(songs):
-        await interaction.response.send_message(f'❌ Invalid position! Choose between 1 and {len(songs)}.', ephemeral=True)
+    song = db.get_song_at(playlist_obj["id"], position)
+    if not song:
+        await interaction.response.send_message(f'❌ Invalid position! Choose between 1 and {db.count_songs(playlist_obj["id"])}.', ephemeral=True)
         return
-    song = songs[position - 1]
     result = db.remove_song_from_playlist(playlist_obj["id"], song["id"])
     if result['success']:
         await interaction.response.send_message(f'✅ Removed **{song["title"]}** from playlist **{playlist}**', ephemeral=True)
@@ -474,9 +2848,9 @@ async def playlist_move(interaction: discord.Interaction, playlist: str, from_po
     if not playlist_obj:
         await interaction.response.send_message(f'❌ Playlist "{playlist}" not found!', ephemeral=True)
         return
-    songs = db.get_songs(playlist_obj["id"])
-    if from_pos < 1 or from_pos > len(songs) or to_pos < 1 or to_pos > len(songs):
-        await interaction.response.send_message(f'❌ Invalid position! Choose between 1 and {len(songs)}.', ephemeral=True)
+    count = db.count_songs(playlist_obj["id"])
+    if from_pos < 1 or from_pos > count or to_pos < 1 or to_pos > count:
+        await interaction.response.send_message(f'❌ Invalid position! Choose between 1 and {count}.', ephemeral=True)
         return
     if from_pos == to_pos:
         await interaction.response.send_message('❌ Song is already at that position!', ephemeral=True)
@@ -496,11 +2870,10 @@ async def public_playlist_remove(interaction: discord.Interaction, playlist: str
     if not playlist_obj:
         await interaction.response.send_message(f'❌ Public playlist "{playlist}" not found!')
         return
-    songs = db.get_songs(playlist_obj["id"])
-    if position < 1 or position > len(songs):
-        await interaction.response.send_message(f'❌ Invalid position! Choose between 1 and {len(songs)}.')
+    song = db.get_song_at(playlist_obj["id"], position)
+    if not song:
+        await interaction.response.send_message(f'❌ Invalid position! Choose between 1 and {db.count_songs(playlist_obj["id"])}.')
         return
-    song = songs[position - 1]
     result = db.remove_song_from_playlist(playlist_obj["id"], song["id"])
     if result['success']:
         await interaction.response.send_message(f'✅ Removed **{song["title"]}** from public playlist **{playlist}**')
@@ -516,9 +2889,9 @@ async def public_playlist_move(interaction: discord.Interaction, playlist: str,
     if not playlist_obj:
         await interaction.response.send_message(f'❌ Public playlist "{playlist}" not found!')
         return
-    songs = db.get_songs(playlist_obj["id"])
-    if from_pos < 1 or from_pos > len(songs) or to_pos < 1 or to_pos > len(songs):
-        await interaction.response.send_message(f'❌ Invalid position! Choose between 1 and {len(songs)}.')
+    count = db.count_songs(playlist_obj["id"])
+    if from_pos < 1 or from_pos > count or to_pos < 1 or to_pos > count:
+        await interaction.response.send_message(f'❌ Invalid position! Choose between 1 and {count}.')
         return
     if from_pos == to_pos:
         await interaction.response.send_message('❌ Song is already at that position!')
@@ -535,13 +2908,13 @@ async def playlist_shuffle(interaction: discord.Interaction, playlist: str):
     if not playlist_obj:
         await interaction.response.send_message(f'❌ Playlist "{playlist}" not found!', ephemeral=True)
         return
-    songs = db.get_songs(playlist_obj["id"])
-    if len(songs) < 2:
+    count = db.count_songs(playlist_obj["id"])
+    if count < 2:
         await interaction.response.send_message('❌ Playlist needs at least 2 songs to shuffle!', ephemeral=True)
         return
     result = db.shuffle_playlist(playlist_obj["id"])
     if result['success']:
-        await interaction.response.send_message(f'✅ Shuffled playlist **{playlist}** ({len(songs)} songs)', ephemeral=True)
+        await interaction.response.send_message(f'✅ Shuffled playlist **{playlist}** ({count} songs)', ephemeral=True)
     else:
         await interaction.response.send_message('❌ Failed to shuffle playlist', ephemeral=True)
 
@@ -554,56 +2927,636 @@ async def public_playlist_shuffle(interaction: discord.Interaction, playlist: st
     if not playlist_obj:
         await interaction.response.send_message(f'❌ Public playlist "{playlist}" not found!')
         return
-    songs = db.get_songs(playlist_obj["id"])
-    if len(songs) < 2:
+    count = db.count_songs(playlist_obj["id"])
+    if count < 2:
         await interaction.response.send_message('❌ Playlist needs at least 2 songs to shuffle!')
         return
     result = db.shuffle_playlist(playlist_obj["id"])
     if result['success']:
-        await interaction.response.send_message(f'✅ Shuffled public playlist **{playlist}** ({len(songs)} songs)')
+        await interaction.response.send_message(f'✅ Shuffled public playlist **{playlist}** ({count} songs)')
     else:
         await interaction.response.send_message('❌ Failed to shuffle public playlist')
 
-async def play_next_song(guild_id, vc):
-    queue = queues.get(guild_id)
-    if not queue:
-        return
-    song = queue.pop(0)
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'quiet': True,
-        'no_warnings': True,
-        'noplaylist': True,
-        'ffmpeg_location': 'ffmpeg',
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+AUTOCOMPLETE_LIMIT = 25  # Discord shows at most 25 choices
+
+def playlist_choices(interaction, current, accept):
+    # Autocomplete skips interaction_check, so playlists may still be loading
+    if not db.loaded:
+        return []
+    playlists = db.search_playlists(str(interaction.guild.id), current, AUTOCOMPLETE_LIMIT, accept)
+    return [app_commands.Choice(name=(p["name"] + (' (public)' if p["is_public"] else ''))[:100], value=p["name"]) for p in playlists]
+
+def song_position_choices(interaction, current, public):
+    if not db.loaded:
+        return []
+    guild_id = str(interaction.guild.id)
+    name = getattr(interaction.namespace, 'playlist', None)
+    if public:
+        playlist = db.get_public_playlist_by_name(name, guild_id)
+    else:
+        playlist = db.get_playlist_by_name(name, str(interaction.user.id), guild_id)
+    if not playlist:
+        return []
+    current = current.strip()
+    if not current or current.isdigit():
+        start = max(1, int(current)) if current else 1
+        songs = [(start + i, s) for i, s in enumerate(db.get_songs(playlist["id"], AUTOCOMPLETE_LIMIT, start - 1))]
+    else:
+        matches = db.search_songs(guild_id, current, AUTOCOMPLETE_LIMIT, lambda s: s["playlist_id"] == playlist["id"])
+        songs = sorted((db.get_song_position(playlist["id"], s["id"]), s) for s in matches)
+    return [app_commands.Choice(name=f'{position}. {s["title"] or s["url"]}'[:100], value=position) for position, s in songs]
+
+def private_playlist_autocomplete(interaction, current):
+    user_id = str(interaction.user.id)
+    return playlist_choices(interaction, current, lambda p: not p["is_public"] and p["user_id"] == user_id)
+
+def public_playlist_autocomplete(interaction, current):
+    return playlist_choices(interaction, current, lambda p: p["is_public"])
+
+def visible_playlist_autocomplete(interaction, current):
+    user_id = str(interaction.user.id)
+    return playlist_choices(interaction, current, lambda p: p["is_public"] or p["user_id"] == user_id)
+
+@play.autocomplete('query')
+async def play_autocomplete(interaction: discord.Interaction, current: str):
+    # Songs from this guild's playlists; anything else typed is searched on /play
+    if not db.loaded or not current.strip() or is_url(current):
+        return []
+    choices = {}
+    for s in db.search_songs(str(interaction.guild.id), current, AUTOCOMPLETE_LIMIT * 2):
+        if len(s["url"]) <= 100 and s["url"] not in choices:
+            choices[s["url"]] = app_commands.Choice(name=(s["title"] or s["url"])[:100], value=s["url"])
+    return list(choices.values())[:AUTOCOMPLETE_LIMIT]
+
+@playlist_play.autocomplete('name')
+@playlist_show.autocomplete('name')
+async def visible_playlist_name_autocomplete(interaction: discord.Interaction, current: str):
+    return visible_playlist_autocomplete(interaction, current)
+
+@playlist_delete.autocomplete('name')
+async def private_playlist_name_autocomplete(interaction: discord.Interaction, current: str):
+    return private_playlist_autocomplete(interaction, current)
+
+@playlist_add.autocomplete('playlist')
+@playlist_import.autocomplete('playlist')
+@playlist_remove.autocomplete('playlist')
+@playlist_move.autocomplete('playlist')
+@playlist_shuffle.autocomplete('playlist')
+async def private_playlist_arg_autocomplete(interaction: discord.Interaction, current: str):
+    return private_playlist_autocomplete(interaction, current)
+
+@public_playlist_delete.autocomplete('name')
+async def public_playlist_name_autocomplete(interaction: discord.Interaction, current: str):
+    return public_playlist_autocomplete(interaction, current)
+
+@public_playlist_add.autocomplete('playlist')
+@public_playlist_import.autocomplete('playlist')
+@public_playlist_remove.autocomplete('playlist')
+@public_playlist_move.autocomplete('playlist')
+@public_playlist_shuffle.autocomplete('playlist')
+async def public_playlist_arg_autocomplete(interaction: discord.Interaction, current: str):
+    return public_playlist_autocomplete(interaction, current)
+
+@playlist_remove.autocomplete('position')
+@playlist_move.autocomplete('from_pos')
+@playlist_move.autocomplete('to_pos')
+async def private_song_autocomplete(interaction: discord.Interaction, current: str):
+    return song_position_choices(interaction, current, public=False)
+
+@public_playlist_remove.autocomplete('position')
+@public_playlist_move.autocomplete('from_pos')
+@public_playlist_move.autocomplete('to_pos')
+async def public_song_autocomplete(interaction: discord.Interaction, current: str):
+    return song_position_choices(interaction, current, public=True)
+
+PREFETCH_DEPTH = int(os.environ.get("PREFETCH_DEPTH", "3"))
+# Spawn the next track's ffmpeg this many seconds before the current one ends
+FFMPEG_WARMUP_LEAD = int(os.environ.get("FFMPEG_WARMUP_LEAD", "15"))
+FFMPEG_BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+# discord.py sends one 20 ms Opus frame per read()
+FRAME_SECONDS = 0.02
+# Seconds to wait before each voice reconnect attempt; jittered by +/-20%
+VOICE_RECONNECT_DELAYS = [float(d) for d in os.environ.get("VOICE_RECONNECT_DELAYS", "1,2,5,10,30,60").split(',')]
+# Seconds before trying the next song again when the extractor turned it away
+EXTRACT_BUSY_RETRY = 2.0
+# Leave after this many seconds with nothing playing (paused counts), or with no listeners left
+IDLE_TIMEOUT = int(os.environ.get("IDLE_TIMEOUT", "300"))
+EMPTY_CHANNEL_TIMEOUT = int(os.environ.get("EMPTY_CHANNEL_TIMEOUT", "60"))
+# Voice sessions this process will hold at once; 0 means no limit
+MAX_VOICE_SESSIONS = int(os.environ.get("MAX_VOICE_SESSIONS", "0"))
+REAPER_INTERVAL = 15
+
+async def create_source(info, guild_id, needs_pcm=False, start_at=0, gain_db=None):
+    # YouTube's bestaudio is usually Opus in WebM; ffmpeg can remux those packets
+    # untouched instead of decoding to PCM for discord.py to re-encode. Anything
+    # that has to modify the samples (filters, volume) must ask for PCM.
+    counts = playback_paths.setdefault(guild_id, {'opus': 0, 'pcm': 0, 'cache': 0})
+    # Input seeking, so a resumed track doesn't download what was already played
+    seek = f' -ss {start_at:.2f}' if start_at else ''
+    # A measured loudness gain needs ffmpeg to re-encode; it is still one
+    # constant filter in the ffmpeg process rather than work in ours
+    if gain_db is not None and abs(gain_db) >= LOUDNESS_MIN_GAIN_DB:
+        opus_args = {'options': f'-vn -af volume={gain_db:.2f}dB'}
+    else:
+        opus_args = {'codec': 'copy', 'options': '-vn'}
+    if audio_cache is not None and not needs_pcm:
+        local_path = audio_cache.lookup(info['id'])
+        if local_path:
+            counts['cache'] += 1
+            return discord.FFmpegOpusAudio(local_path, before_options=seek.strip() or None, **opus_args)
+        if not info['url'] or stream_url_expiry(info['url']) - time.time() < STREAM_EXPIRY_MARGIN:
+            # Resolved for the cached file, which was evicted in the meantime
+            info = await resolver.resolve(info['id'], guild_id=guild_id)
+        if info['duration'] and audio_cache.record_play(info['id']):
+            audio_cache.schedule_populate(info['id'], info['url'], info.get('acodec'))
+    audio_url = info['url']
+    path = 'pcm'
+    if not needs_pcm:
+        codec = info.get('acodec')
+        if codec is None:
+            try:
+                codec, _ = await discord.FFmpegOpusAudio.probe(audio_url)
+            except Exception as e:
+                print(f"Failed to probe codec for {audio_url}: {e}")
+        if codec == 'opus' and info.get('asr') in (None, 48000):
+            path = 'opus'
+    counts[path] += 1
+    if path == 'opus':
+        return discord.FFmpegOpusAudio(audio_url, before_options=FFMPEG_BEFORE_OPTIONS + seek, **opus_args)
+    return discord.FFmpegPCMAudio(audio_url, before_options=FFMPEG_BEFORE_OPTIONS + seek, options=opus_args['options'])
+
+# Volume, normalization and crossfades decode to PCM instead of passing Opus
+# through, so they cost CPU; normalization and crossfades are off by default
+CROSSFADE_SECONDS = float(os.environ.get("CROSSFADE_SECONDS", "0"))
+FRAME_VALUES = 960 * 2  # interleaved 16-bit stereo samples in one 20 ms frame
+NORMALIZE_TARGET_RMS = 32768 * 10 ** (-20 / 20)
+NORMALIZE_MAX_GAIN = 4.0
+# Frames quieter than -50 dBFS don't count towards the loudness estimate
+NORMALIZE_FLOOR = (32768 * 10 ** (-50 / 20)) ** 2
+# Roughly a 3 second moving average
+NORMALIZE_SMOOTHING = FRAME_SECONDS / 3
+GAIN_RAMP = numpy.repeat(numpy.linspace(0, 1, FRAME_VALUES // 2, dtype=numpy.float32), 2) if numpy is not None else None
+
+class DSPSource(discord.AudioSource):
+    # Applies the player's volume, loudness normalization and crossfades to
+    # PCM frames. Buffers are allocated once per track, so the voice thread
+    # only does in-place array math.
+    def __init__(self, source, player, seconds=None, gain_db=None):
+        self.source = source
+        self.player = player
+        # A measured gain replaces the adaptive estimate
+        self.track_gain = 10 ** (gain_db / 20) if gain_db is not None else None
+        self.work = numpy.zeros(FRAME_VALUES, dtype=numpy.float32)
+        self.gains = numpy.empty(FRAME_VALUES, dtype=numpy.float32)
+        self.out = numpy.zeros(FRAME_VALUES, dtype=numpy.int16)
+        self.frames = 0
+        self.expected_frames = int(seconds / FRAME_SECONDS) if seconds else None
+        self.fade = 1.0
+        self.gain = None  # applied at the end of the last frame
+        self.mean_square = NORMALIZE_TARGET_RMS ** 2
+        # The next track's source, set from the event loop once it is warm
+        self.upcoming = None
+
+    def render(self, fade):
+        data = self.source.read()
+        if len(data) != FRAME_VALUES * 2:
+            return False
+        numpy.copyto(self.work, numpy.frombuffer(data, dtype=numpy.int16), casting='unsafe')
+        gain = self.player.volume * fade
+        if self.track_gain is not None:
+            gain *= self.track_gain
+        elif AUDIO_NORMALIZE:
+            mean_square = float(numpy.dot(self.work, self.work)) / FRAME_VALUES
+            # Silence and quiet intros shouldn't drag the gain up
+            if mean_square > NORMALIZE_FLOOR:
+                self.mean_square += (mean_square - self.mean_square) * NORMALIZE_SMOOTHING
+            gain *= min(NORMALIZE_MAX_GAIN, NORMALIZE_TARGET_RMS / self.mean_square ** 0.5)
+        start = gain if self.gain is None else self.gain
+        if start == gain:
+            self.work *= gain
+        else:
+            # Ramped across the frame so gain changes don't click
+            numpy.multiply(GAIN_RAMP, gain - start, out=self.gains)
+            self.gains += start
+            self.work *= self.gains
+        self.gain = gain
+        self.frames += 1
+        return True
+
+    def read(self):
+        # Fades in from wherever a crossfade left this track, and out over the
+        # last CROSSFADE_SECONDS while mixing in the next one
+        fade = 1.0
+        if CROSSFADE_SECONDS:
+            fade = min(1.0, self.fade + FRAME_SECONDS / CROSSFADE_SECONDS)
+            if self.expected_frames:
+                fade = min(fade, max(0.0, (self.expected_frames - self.frames) * FRAME_SECONDS / CROSSFADE_SECONDS))
+        if not self.render(fade):
+            return b''
+        self.fade = fade
+        upcoming = self.upcoming
+        if fade < 1.0 and upcoming is not None and upcoming.render(1.0 - fade):
+            upcoming.fade = 1.0 - fade
+            self.work += upcoming.work
+        numpy.clip(self.work, -32768, 32767, out=self.work)
+        numpy.copyto(self.out, self.work, casting='unsafe')
+        return self.out.tobytes()
+
+    def cleanup(self):
+        self.upcoming = None
+        self.source.cleanup()
+
+def discard_warm_source(song):
+    source = song.pop('source', None)
+    song.pop('source_expires_at', None)
+    if source:
+        source.cleanup()
+
+class GuildPlayer:
+    def __init__(self, guild_id, vc):
+        self.guild_id = guild_id
+        self.vc = vc
+        self.queue = deque()
+        self.now_playing = None
+        self.track_started_at = 0.0
+        self.track_ended_at = None
+        self.prefetcher = None
+        # Serializes track changes between the after-callback and commands
+        self.advance_lock = asyncio.Lock()
+        # Frames read from the current source, and where in the track it started
+        self.frames = 0
+        self.start_offset = 0.0
+        self.reconnecting = False
+        # Set by the reaper when it first sees the player idle or alone
+        self.idle_since = time.monotonic()
+        self.alone_since = None
+        self.volume = 1.0
+
+    def is_active(self):
+        return self.vc.is_playing() or self.vc.is_paused()
+
+    def position(self):
+        return self.start_offset + self.frames * FRAME_SECONDS
+
+    def uses_dsp(self):
+        return numpy is not None and (self.volume != 1.0 or CROSSFADE_SECONDS > 0)
+
+    async def build_source(self, song, info, start_at=0):
+        gain_db = loudness.gain_for(song)
+        if self.uses_dsp():
+            source = await create_source(info, self.guild_id, needs_pcm=True, start_at=start_at)
+            return DSPSource(source, self, info['duration'] - start_at, gain_db)
+        return await create_source(info, self.guild_id, start_at=start_at, gain_db=gain_db)
+
+    def enqueue(self, songs):
+        self.queue.extend(songs)
+        if self.now_playing is not None:
+            self.reset_prefetch()
+
+    def replace_queue(self, songs):
+        self.clear_queue()
+        self.queue.extend(songs)
+
+    def clear_queue(self):
+        self.cancel_prefetch()
+        self.queue.clear()
+
+    def remove_at(self, index):
+        song = self.queue[index]
+        del self.queue[index]
+        discard_warm_source(song)
+        self.reset_prefetch()
+        return song
+
+    def move(self, from_index, to_index):
+        song = self.queue[from_index]
+        del self.queue[from_index]
+        self.queue.insert(to_index, song)
+        self.reset_prefetch()
+
+    def shuffle(self):
+        # Only permutes this session's queue; the stored playlist keeps its order
+        songs = list(self.queue)
+        random.shuffle(songs)
+        self.queue = deque(songs)
+        self.reset_prefetch()
+
+    def skip(self):
+        # The after-callback advances to the next entry
+        self.vc.stop()
+
+    def finish_track(self):
+        if self.now_playing is not None:
+            history.record(self.guild_id, self.now_playing, self.position())
+            self.now_playing = None
+
+    async def disconnect(self):
+        # Unregistered first so on_voice_state_update doesn't try to reconnect
+        if players.get(self.guild_id) is self:
+            del players[self.guild_id]
+        self.clear_queue()
+        self.finish_track()
+        if self.is_active():
+            self.vc.stop()
+        await self.vc.disconnect()
+
+    async def reconnect(self, channel):
+        self.reconnecting = True
+        song, position = self.now_playing, self.position()
+        self.cancel_prefetch()
+        self.now_playing = None
+        try:
+            # Drops discord.py's record of the dead connection so connect() is allowed
+            await self.vc.disconnect(force=True)
+        except Exception:
+            pass
+        vc = None
+        for attempt, delay in enumerate(VOICE_RECONNECT_DELAYS, 1):
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            if players.get(self.guild_id) is not self:
+                return
+            try:
+                vc = await channel.connect()
+                break
+            except Exception as e:
+                print(f"Reconnect attempt {attempt} to {channel.name} failed: {e}")
+        if vc is None:
+            print(f"Giving up reconnecting to {channel.name} in guild {self.guild_id}")
+            # /leave or the reaper may have removed it during the last attempt
+            if players.get(self.guild_id) is self:
+                del players[self.guild_id]
+            self.clear_queue()
+            return
+        self.vc = vc
+        self.reconnecting = False
+        self.track_ended_at = None
+        print(f"Reconnected to {channel.name} in guild {self.guild_id}" + (f", resuming at {position:.0f}s" if song else ""))
+        if song is not None:
+            song['resume_at'] = position
+            self.queue.appendleft(song)
+        await self.play_next()
+
+    def cancel_prefetch(self):
+        if self.prefetcher:
+            self.prefetcher.cancel()
+            self.prefetcher = None
+        if isinstance(self.vc.source, DSPSource):
+            self.vc.source.upcoming = None
+        for song in self.queue:
+            discard_warm_source(song)
+
+    def schedule_prefetch(self):
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        remaining = 0
+        if self.now_playing is not None:
+            elapsed = time.monotonic() - self.track_started_at
+            remaining = (self.now_playing.get('seconds') or 0) - elapsed
+        # A crossfade starts reading the next track early, so it must be warm by then
+        lead = max(FFMPEG_WARMUP_LEAD, CROSSFADE_SECONDS + 5)
+        self.prefetcher = asyncio.create_task(self.prefetch(max(0, remaining - lead)))
+
+    def reset_prefetch(self):
+        # The head of the queue may have changed, so its warm source may be stale
+        self.cancel_prefetch()
+        if self.queue and self.now_playing is not None:
+            self.schedule_prefetch()
+
+    async def prefetch(self, warm_in):
+        for song in list(itertools.islice(self.queue, PREFETCH_DEPTH)):
+            try:
+                # Shielded so a reschedule doesn't throw away an extraction in flight
+                info = await asyncio.shield(background_resolve(song['url'], self.guild_id, PRIORITY_PREFETCH))
+                song['seconds'] = info['duration']
+            except Exception as e:
+                print(f"Prefetch failed for {song['url']}: {e}")
+        await asyncio.sleep(warm_in)
+        if not self.queue or 'source' in self.queue[0]:
+            return
+        song = self.queue[0]
+        try:
+            # Re-resolves if the stream URL expired while the current track played
+            info = await asyncio.shield(background_resolve(song['url'], self.guild_id, PRIORITY_PREFETCH))
+        except Exception:
+            return
         try:
-            info = await asyncio.to_thread(ydl.extract_info, song['url'], download=False)
-            audio_url = info['url']
+            source = await self.build_source(song, info)
         except Exception as e:
-            print(f"Failed to extract audio URL for {song['url']}: {e}")
-            if queues.get(guild_id):
-                await play_next_song(guild_id, vc)
+            # Nobody awaits this task; play_next starts the song cold instead
+            print(f"Prefetch failed for {song['url']}: {e}")
+            return
+        if not self.queue or self.queue[0] is not song or 'source' in song:
+            source.cleanup()
             return
-    # Stream directly instead of downloading to temp file
-    source = discord.FFmpegPCMAudio(audio_url)
-    vc.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(play_next_song(guild_id, vc), bot.loop) if queues.get(guild_id) else None)
+        song['source'] = source
+        if isinstance(source, DSPSource) and isinstance(self.vc.source, DSPSource):
+            self.vc.source.upcoming = source
+        if audio_cache is not None and audio_cache.contains(info['id']):
+            song['source_expires_at'] = float('inf')
+        else:
+            song['source_expires_at'] = stream_url_expiry(info['url'])
+        song['seconds'] = info['duration']
+
+    def retry_later(self):
+        async def retry():
+            await asyncio.sleep(EXTRACT_BUSY_RETRY * random.uniform(0.8, 1.2))
+            await self.play_next()
+        asyncio.create_task(retry())
+
+    def after_track(self, error):
+        # Called from the voice thread
+        if error:
+            print(f"Playback error in guild {self.guild_id}: {error}")
+        self.track_ended_at = time.monotonic()
+        asyncio.run_coroutine_threadsafe(self.play_next(), bot.loop)
+
+    async def play_next(self):
+        async with self.advance_lock:
+            # A dropped connection also ends the track; reconnect() restarts it
+            if self.reconnecting or not self.vc.is_connected() or self.is_active():
+                return
+            self.finish_track()
+            # Only a gap if the next track follows straight on from the last one
+            ended_at, self.track_ended_at = self.track_ended_at, None
+            while self.queue:
+                song = self.queue.popleft()
+                resume_at = song.pop('resume_at', 0)
+                source = song.pop('source', None)
+                if source and song.pop('source_expires_at') - time.time() < STREAM_EXPIRY_MARGIN:
+                    source.cleanup()
+                    source = None
+                if source is None:
+                    try:
+                        info = await resolve_for_playback(song['url'], self.guild_id)
+                        song['seconds'] = info['duration']
+                    except ExtractorBusy:
+                        # Overloaded rather than a dead link; keep the song and try again
+                        print(f"Extractor busy, retrying {song['url']} in guild {self.guild_id}")
+                        if resume_at:
+                            song['resume_at'] = resume_at
+                        self.queue.appendleft(song)
+                        self.retry_later()
+                        return
+                    except Exception as e:
+                        print(f"Failed to extract audio URL for {song['url']}: {e}")
+                        continue
+                    # Stream directly instead of downloading to temp file
+                    source = await self.build_source(song, info, resume_at)
+                # Frames a crossfade already played
+                if isinstance(source, DSPSource):
+                    resume_at += source.frames * FRAME_SECONDS
+                self.watch_source(source, song.pop('requested_at', None), ended_at)
+                self.frames = 0
+                try:
+                    self.vc.play(source, after=self.after_track)
+                except discord.ClientException as e:
+                    print(f"Failed to start playback in guild {self.guild_id}: {e}")
+                    source.cleanup()
+                    return
+                self.now_playing = song
+                self.start_offset = resume_at
+                self.track_started_at = time.monotonic() - resume_at
+                if self.queue:
+                    self.schedule_prefetch()
+                return
+
+    def watch_source(self, source, requested_at, ended_at):
+        # Counts frames as the voice thread reads them, so a reconnect knows
+        # where to resume; the first one also feeds the latency histograms
+        read = source.read
+        def counted_read():
+            if self.frames == 0 and METRICS_PORT:
+                if requested_at is not None:
+                    first_audio_seconds.observe(time.time() - requested_at)
+                if ended_at is not None:
+                    track_gap_seconds.observe(time.monotonic() - ended_at)
+            self.frames += 1
+            return read()
+        source.read = counted_read
+
+class VoiceSessionLimit(Exception):
+    pass
+
+connecting_guilds = set()
+reaper_stats = {"idle": 0, "empty_channel": 0, "orphaned_voice_clients": 0, "ffmpeg_killed": 0, "rejected_sessions": 0}
+ffmpeg_suspects = set()
+
+async def connect_player(guild_id, channel):
+    # Connections still being set up count against the cap too
+    if MAX_VOICE_SESSIONS and len(players) + len(connecting_guilds) >= MAX_VOICE_SESSIONS:
+        reaper_stats["rejected_sessions"] += 1
+        raise VoiceSessionLimit('I am playing in too many voice channels right now, try again later')
+    connecting_guilds.add(guild_id)
+    try:
+        vc = await channel.connect()
+    finally:
+        connecting_guilds.discard(guild_id)
+    player = players[guild_id] = GuildPlayer(guild_id, vc)
+    return player
+
+async def ensure_player(interaction):
+    player = players.get(interaction.guild.id)
+    if player:
+        return player
+    if not interaction.user.voice:
+        return None
+    return await connect_player(interaction.guild.id, interaction.user.voice.channel)
+
+def live_ffmpeg_pids():
+    pids = set()
+    for player in players.values():
+        sources = [player.vc.source] + [song.get('source') for song in player.queue]
+        while sources:
+            source = sources.pop()
+            if isinstance(source, DSPSource):
+                # The ffmpeg sits on the wrapped source, and a crossfade's next
+                # track on upcoming
+                sources += [source.source, source.upcoming]
+                continue
+            process = getattr(source, '_process', None)
+            if process is not None:
+                pids.add(process.pid)
+    return pids
+
+def kill_orphaned_ffmpeg():
+    global ffmpeg_suspects
+    # Playback sources write to pipe:1; audio cache downloads write to a file and are left alone
+    live = live_ffmpeg_pids()
+    orphans = {pid for pid, argv in ffmpeg_children().items() if 'pipe:1' in argv and pid not in live}
+    # Only kill what was already orphaned on the last sweep, not a source mid hand-over
+    for pid in orphans & ffmpeg_suspects:
+        try:
+            os.kill(pid, signal.SIGKILL)
+            reaper_stats["ffmpeg_killed"] += 1
+            print(f"Killed orphaned ffmpeg process {pid}")
+        except OSError:
+            pass
+    ffmpeg_suspects = orphans - ffmpeg_suspects
+
+@tasks.loop(seconds=REAPER_INTERVAL)
+async def reap_idle_players():
+    now = time.monotonic()
+    for guild_id, player in list(players.items()):
+        if player.reconnecting:
+            continue
+        if player.vc.is_playing() or player.advance_lock.locked():
+            player.idle_since = None
+        elif player.idle_since is None:
+            player.idle_since = now
+        if any(not member.bot for member in player.vc.channel.members):
+            player.alone_since = None
+        elif player.alone_since is None:
+            player.alone_since = now
+        if player.idle_since is not None and now - player.idle_since >= IDLE_TIMEOUT:
+            reason = 'idle'
+        elif player.alone_since is not None and now - player.alone_since >= EMPTY_CHANNEL_TIMEOUT:
+            reason = 'empty_channel'
+        else:
+            continue
+        reaper_stats[reason] += 1
+        print(f"Leaving {player.vc.channel.name} in guild {guild_id} ({reason.replace('_', ' ')})")
+        try:
+            await player.disconnect()
+        except Exception as e:
+            print(f"Error disconnecting from guild {guild_id}: {e}")
+    # Voice clients no player owns, e.g. left behind by a command that failed halfway
+    for vc in list(bot.voice_clients):
+        if vc.guild.id in connecting_guilds:
+            # discord.py lists the client before connect() has returned
+            continue
+        player = players.get(vc.guild.id)
+        if player is None or (player.vc is not vc and not player.reconnecting):
+            reaper_stats["orphaned_voice_clients"] += 1
+            try:
+                await vc.disconnect(force=True)
+            except Exception as e:
+                print(f"Error disconnecting orphaned voice client in guild {vc.guild.id}: {e}")
+    for guild_id in [g for g in playback_paths if g not in players]:
+        for path, count in playback_paths.pop(guild_id).items():
+            retired_playback_paths[path] += count
+    kill_orphaned_ffmpeg()
 
 @bot.event
 async def on_voice_state_update(member, before, after):
     if member == bot.user and before.channel and not after.channel:
-        # Bot was disconnected, attempt to reconnect after 5 seconds
-        await asyncio.sleep(5)
-        guild = member.guild
-        if guild.id in connections:
-            try:
-                vc = await before.channel.connect()
-                connections[guild.id] = vc
-                print(f"Reconnected to {before.channel.name} in {guild.name}")
-            except Exception as e:
-                print(f"Failed to reconnect: {e}")
+        # Bot was disconnected; reconnect with backoff and resume where playback stopped
+        player = players.get(member.guild.id)
+        if player and not player.reconnecting:
+            await player.reconnect(before.channel)
 
 def has_music_guy_role(member):
     return any(role.name == 'Music Guy' for role in member.roles)
 
-bot.run(os.getenv('DISCORD_TOKEN'))
\ No newline at end of file
+if __name__ == '__main__':
+    mark_startup('module init')
+    bot.run(os.getenv('DISCORD_TOKEN'))
+    resolver_cache.save()
+    if audio_cache is not None:
+        audio_cache.save()
+    if loudness.dirty:
+        loudness.save()
+    if history.pending:
+        history.write(*history.take_batch())
+    if process_pool is not None:
+        process_pool.close()
+    db.close()
\ No newline at end of file
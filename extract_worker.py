@@ -0,0 +1,39 @@
+# Long-lived yt_dlp worker used by bot.py when EXTRACT_MODE=process. Reads one
+# JSON request per line on stdin and writes one JSON reply per line on stdout.
+import json
+import sys
+import yt_dlp
+
+# The fields bot.py reads from an info dict; the rest (formats, thumbnails...)
+# would only make the replies bigger
+INFO_KEYS = ('_type', 'id', 'title', 'duration', 'duration_string', 'webpage_url', 'url', 'acodec', 'asr', 'ext')
+
+def trim(info):
+    if info is None:
+        return None
+    result = {key: info[key] for key in INFO_KEYS if key in info}
+    if 'entries' in info:
+        result['entries'] = [trim(entry) for entry in info['entries']]
+    return result
+
+def main():
+    replies = sys.stdout
+    # Anything yt_dlp prints must not end up in the reply stream
+    sys.stdout = sys.stderr
+    instances = {}
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            key = json.dumps(request['opts'], sort_keys=True)
+            ydl = instances.get(key)
+            if ydl is None:
+                ydl = instances[key] = yt_dlp.YoutubeDL(request['opts'])
+            info = ydl.extract_info(request['url'], download=False)
+            reply = {'info': trim(ydl.sanitize_info(info))}
+        except Exception as e:
+            reply = {'error': str(e)}
+        replies.write(json.dumps(reply) + '\n')
+        replies.flush()
+
+if __name__ == '__main__':
+    main()